@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""
+Offline load test of the Mentions, Relay, WatchDog and PostToRoom plugins.
+
+Each plugin runs against a fake homeserver client, and Relay against a local fake webhook server with configurable
+latency and error rate. A synthetic stream of events (or HTTP requests, for PostToRoom) is replayed through each
+plugin, and throughput, latency percentiles and peak memory are reported per plugin. No homeserver, database server
+or network access is needed, plugin databases are SQLite files in a temporary directory.
+
+Exits with a non-zero status if a plugin didn't handle every event, so that it can be run as a pre-deploy check.
+
+    .venv/bin/python bench/loadtest.py
+    .venv/bin/python bench/loadtest.py --events 5000 --webhook-latency 0.05 --webhook-error-rate 0.1
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Dict, List, Optional
+from urllib.parse import parse_qs
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+for plugin_dir in ("mentions", "relay", "watchdog", "post_to_room"):
+    sys.path.insert(0, os.path.join(PLUGINS_DIR, plugin_dir))
+
+import aiohttp
+from aiohttp import web
+from mautrix.errors import MNotFound
+from mautrix.types import (EventID, EventType, MessageEvent, MessageType, RoomAliasInfo,
+                           RoomDirectoryResponse, RoomDirectoryVisibility, RoomID, TextMessageEventContent, UserID)
+from mautrix.types.misc import PublicRoomInfo
+from mautrix.util.async_db import Database
+from ruamel import yaml
+from yarl import URL
+
+from mentions import Mentions
+from post_to_room import PostToRoom
+from relay import Relay
+from watchdog import WatchDog
+from wporg_directory import get_shared_room_directory
+from wporg_send import get_send_scheduler
+
+SERVER_NAME = "community.wordpress.org"
+ALERTS_ROOM_ID = RoomID(f"!alerts:{SERVER_NAME}")
+WORDS = ["the", "release", "is", "blocked", "on", "review", "please", "take", "a", "look", "at", "this", "patch",
+         "build", "failing", "since", "yesterday", "can", "someone", "from", "help", "with", "tests", "thanks"]
+
+
+# Stands in for the plugins' `self.client`, with rooms published in a paginated room directory
+class FakeHomeserver:
+    mxid = UserID(f"@loadtestbot:{SERVER_NAME}")
+
+    def __init__(self, rooms: int, latency: float):
+        self.latency = latency
+        self.room_ids = [RoomID(f"!room{i}:{SERVER_NAME}") for i in range(rooms)]
+        self.rooms = {room_id: {"name": f"Room {i}", "topic": f"Topic of room {i}", "alias": f"#room-{i}:{SERVER_NAME}"}
+                      for i, room_id in enumerate(self.room_ids)}
+        self.aliases = {room["alias"]: room_id for room_id, room in self.rooms.items()}
+        self.sent: Dict[RoomID, int] = {}
+        self.requests: Dict[str, int] = {}
+
+    async def request(self, endpoint: str) -> None:
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message_event(self, room_id: RoomID, event_type: EventType, content, **kwargs) -> EventID:
+        await self.request("send")
+        self.sent[room_id] = self.sent.get(room_id, 0) + 1
+        return EventID(f"$sent{sum(self.sent.values())}")
+
+    async def send_message(self, room_id: RoomID, content, **kwargs) -> EventID:
+        return await self.send_message_event(room_id, EventType.ROOM_MESSAGE, content)
+
+    async def send_text(self, room_id: RoomID, text: str, html: Optional[str] = None, **kwargs) -> EventID:
+        return await self.send_message_event(room_id, EventType.ROOM_MESSAGE, text)
+
+    async def send_notice(self, room_id: RoomID, text: str, html: Optional[str] = None, **kwargs) -> EventID:
+        return await self.send_message_event(room_id, EventType.ROOM_MESSAGE, text)
+
+    async def send_markdown(self, room_id: RoomID, markdown: str, **kwargs) -> EventID:
+        return await self.send_message_event(room_id, EventType.ROOM_MESSAGE, markdown)
+
+    async def get_room_directory(self, limit: Optional[int] = None, server: Optional[str] = None,
+                                 since: Optional[str] = None, **kwargs) -> RoomDirectoryResponse:
+        await self.request("room_directory")
+        start = int(since) if since else 0
+        end = start + (limit or 100)
+        chunk = [
+            PublicRoomInfo(room_id=room_id, num_joined_members=10, world_readable=True, guest_can_join=False,
+                           name=self.rooms[room_id]["name"], topic=self.rooms[room_id]["topic"],
+                           canonical_alias=self.rooms[room_id]["alias"])
+            for room_id in self.room_ids[start:end]
+        ]
+        next_batch = str(end) if end < len(self.room_ids) else None
+        return RoomDirectoryResponse(chunk=chunk, next_batch=next_batch, total_room_count_estimate=len(self.room_ids))
+
+    async def resolve_room_alias(self, room_alias: str) -> RoomAliasInfo:
+        await self.request("resolve_room_alias")
+        if room_alias not in self.aliases:
+            raise MNotFound(404, "Room alias not found")
+        return RoomAliasInfo(room_id=self.aliases[room_alias], servers=[SERVER_NAME])
+
+    async def get_room_directory_visibility(self, room_id: RoomID) -> RoomDirectoryVisibility:
+        await self.request("room_directory_visibility")
+        return RoomDirectoryVisibility.PUBLIC if room_id in self.rooms else RoomDirectoryVisibility.PRIVATE
+
+    async def get_state_event(self, room_id: RoomID, event_type: EventType, state_key: str = ""):
+        await self.request("state")
+        raise MNotFound(404, "Event not found")
+
+    def rename_rooms(self, count: int, cycle: int, rng: random.Random) -> None:
+        for room_id in rng.sample(self.room_ids, min(count, len(self.room_ids))):
+            self.rooms[room_id]["name"] = f"{self.rooms[room_id]['name'].split(' (')[0]} ({cycle})"
+
+
+# Relay's webhook, also serves the groups config of Mentions
+class FakeWebhookServer:
+    def __init__(self, latency: float, error_rate: float, groups_config: str, rng: random.Random):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.groups_config = groups_config
+        self.rng = rng
+        self.received: Dict[str, float] = {}  # event_id -> when it was first received
+        self.requests = 0
+        self.errors = 0
+        self.url = ""
+        self._runner = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/webhook", self.handle_webhook)
+        app.router.add_get("/groups.yaml", self.handle_groups_config)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503)
+
+        if request.content_type == "application/json":
+            event_ids = [payload["event_id"] for payload in await request.json()]
+        else:
+            event_ids = parse_qs(await request.text())["event_id"]
+        now = time.perf_counter()
+        for event_id in event_ids:
+            self.received.setdefault(event_id, now)
+        return web.Response(status=204)
+
+    async def handle_groups_config(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.groups_config, headers={"ETag": '"loadtest"'})
+
+
+# What maubot passes as `self.config`, with the values from the plugin's base-config.yaml
+class Config(dict):
+    def load_and_update(self) -> None:
+        pass
+
+
+def load_config(plugin: str, **overrides) -> Config:
+    with open(os.path.join(PLUGINS_DIR, plugin, "base-config.yaml")) as f:
+        config = Config(yaml.YAML(typ="safe").load(f))
+    config.update(overrides)
+    return config
+
+
+# Request to a plugin's web app, as far as the plugins use it
+class FakeRequest:
+    def __init__(self, query: Dict[str, str], body, headers: Optional[Dict[str, str]] = None):
+        self.rel_url = URL.build(path="/", query=query)
+        self.headers = headers or {}
+        self.match_info = {}
+        self._body = body
+
+    async def json(self):
+        return self._body
+
+
+class Report:
+    def __init__(self, name: str):
+        self.name = name
+        self.operations = 0
+        self.elapsed = 0.0
+        self.latencies: List[float] = []
+        self.peak_memory = 0
+        self.failed = 0
+        self.note = ""
+
+    def print(self) -> None:
+        self.latencies.sort()
+        print(f"  {self.name:<24} {self.operations:>7} {self.elapsed:>8.2f} {self.operations / self.elapsed:>10.0f} "
+              f"{percentile(self.latencies, 50) * 1000:>8.1f} {percentile(self.latencies, 99) * 1000:>8.1f} "
+              f"{self.peak_memory / 2 ** 20:>8.1f} {self.failed:>7}  {self.note}")
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def sentence(rng: random.Random, length: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(length))
+
+
+def make_event(room_id: RoomID, body: str, n: int) -> MessageEvent:
+    return MessageEvent(
+        type=EventType.ROOM_MESSAGE,
+        room_id=room_id,
+        event_id=EventID(f"$event{n}"),
+        sender=UserID(f"@someone:{SERVER_NAME}"),
+        timestamp=int(time.time() * 1000),
+        content=TextMessageEventContent(msgtype=MessageType.TEXT, body=body),
+    )
+
+
+def generate_groups_config(count: int, rng: random.Random) -> str:
+    users = [f"@user{i}:{SERVER_NAME}" for i in range(max(count * 5, 100))]
+    groups = [{"name": f"Team {i}", "keyword": f"team-{i}", "users": rng.sample(users, rng.randint(3, 30))}
+              for i in range(count)]
+    buffer = tempfile.SpooledTemporaryFile(mode="w+")
+    yaml.YAML(typ="safe").dump({"groups": groups}, buffer)
+    buffer.seek(0)
+    return buffer.read()
+
+
+# Runs `handle` for each item, `concurrency` at a time like maubot dispatching events, and records each latency
+async def replay(items: List, handle: Callable[..., Awaitable], concurrency: int, report: Report) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await handle(item)
+            report.latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(run(item) for item in items))
+
+
+async def wait_for(condition: Callable[[], bool], timeout: float) -> bool:
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def create_database(db_dir: str, name: str, upgrade_table) -> Database:
+    database = Database.create(f"sqlite:///{os.path.join(db_dir, name)}.db", upgrade_table=upgrade_table)
+    await database.start()
+    return database
+
+
+async def load_test_mentions(args, homeserver: FakeHomeserver, server: FakeWebhookServer, http: aiohttp.ClientSession,
+                             db_dir: str, rng: random.Random) -> Report:
+    report = Report("mentions")
+    database = await create_database(db_dir, "mentions", Mentions.get_db_upgrade_table())
+    config = load_config("mentions", groups_config_src=f"{server.url}/groups.yaml",
+                         send_rate=args.send_rate, send_burst=args.send_rate)
+    plugin = Mentions(homeserver, asyncio.get_running_loop(), http, "loadtest-mentions",
+                      logging.getLogger("loadtest.mentions"), config, database, None, None, None)
+    await plugin.start()
+    try:
+        if not await wait_for(lambda: plugin.mention_index is not None, timeout=60):
+            report.failed = args.events
+            report.note = "groups config not loaded"
+            return report
+
+        events, expected_pings = [], {}
+        for n in range(args.events):
+            room_id = rng.choice(homeserver.room_ids[:100])
+            if rng.random() < 0.5:
+                body = f"{sentence(rng, 8)} @team-{rng.randrange(args.groups)} {sentence(rng, 8)}"
+                expected_pings[room_id] = expected_pings.get(room_id, 0) + 1
+            else:
+                body = sentence(rng, 20)
+            events.append(make_event(room_id, body, n))
+
+        sent_before = dict(homeserver.sent)
+        started = time.perf_counter()
+        await replay(events, plugin.handle_message, args.concurrency, report)
+        report.elapsed = time.perf_counter() - started
+        report.operations = len(events)
+        report.failed = sum(count - (homeserver.sent.get(room_id, 0) - sent_before.get(room_id, 0))
+                            for room_id, count in expected_pings.items())
+        report.note = f"{args.groups} groups, {sum(expected_pings.values())} pings"
+        return report
+    finally:
+        await plugin.pre_stop()
+        await plugin.stop()
+        await database.stop()
+
+
+async def load_test_relay(args, homeserver: FakeHomeserver, server: FakeWebhookServer, db_dir: str,
+                          rng: random.Random) -> Report:
+    report = Report("relay")
+    database = await create_database(db_dir, "relay", Relay.get_db_upgrade_table())
+    config = load_config("relay", webhook=f"{server.url}/webhook", batch_mode=args.batch_mode,
+                         retry_base_delay=0.01, retry_max_delay=0.5, circuit_breaker_timeout=0.5,
+                         send_rate=args.send_rate, send_burst=args.send_rate)
+    plugin = Relay(homeserver, asyncio.get_running_loop(), None, "loadtest-relay",
+                   logging.getLogger("loadtest.relay"), config, database, None, None, None)
+    await plugin.start()
+    try:
+        events = [make_event(rng.choice(homeserver.room_ids[:100]), sentence(rng, 20), n) for n in range(args.events)]
+        handled = {}
+
+        async def handle(evt: MessageEvent) -> None:
+            handled[evt.event_id] = time.perf_counter()
+            await plugin.handle_message(evt)
+
+        started = time.perf_counter()
+        for evt in events:
+            await handle(evt)
+        delivered = await wait_for(lambda: all(evt.event_id in server.received for evt in events), timeout=300)
+        report.elapsed = (max(server.received.values()) if delivered else time.perf_counter()) - started
+
+        # from the message being handled to the webhook receiving it
+        report.latencies = [server.received[event_id] - handled_at for event_id, handled_at in handled.items()
+                            if event_id in server.received]
+        report.operations = len(events)
+        report.failed = len(events) - len(report.latencies)
+        stats = plugin.get_queue_stats()
+        report.note = (f"{server.requests} webhook requests, {server.errors} failed, {stats['retried']} retried"
+                       f"{', batch mode' if args.batch_mode else ''}")
+        return report
+    finally:
+        await plugin.pre_stop()
+        await plugin.stop()
+        await database.stop()
+
+
+async def load_test_watchdog(args, homeserver: FakeHomeserver, db_dir: str, rng: random.Random) -> Report:
+    report = Report("watchdog")
+    database = await create_database(db_dir, "watchdog", WatchDog.get_db_upgrade_table())
+    config = load_config("watchdog", room=ALERTS_ROOM_ID, digest_mode=True,
+                         send_rate=args.send_rate, send_burst=args.send_rate)
+    plugin = WatchDog(homeserver, asyncio.get_running_loop(), None, "loadtest-watchdog",
+                      logging.getLogger("loadtest.watchdog"), config, database, None, None, None)
+    # start() would also start the monitoring loop, here crawls are run one at a time instead
+    plugin.send_scheduler = get_send_scheduler(homeserver.mxid, args.send_rate, args.send_rate, 4)
+    plugin.room_directory = get_shared_room_directory(homeserver, plugin.log)
+    try:
+        # baseline crawl, nothing to report
+        await plugin.check_rooms(max_retries=0)
+
+        started = time.perf_counter()
+        for cycle in range(args.crawls):
+            homeserver.rename_rooms(args.changes, cycle, rng)
+            alerts_before = homeserver.sent.get(ALERTS_ROOM_ID, 0)
+            crawl_started = time.perf_counter()
+            changed = await plugin.check_rooms(max_retries=0)
+            report.latencies.append(time.perf_counter() - crawl_started)
+            if not changed or homeserver.sent.get(ALERTS_ROOM_ID, 0) == alerts_before:
+                report.failed += 1
+        report.elapsed = time.perf_counter() - started
+        report.operations = args.crawls
+        report.note = f"crawls of {len(homeserver.room_ids)} rooms, {args.changes} renamed each"
+        return report
+    finally:
+        await database.stop()
+
+
+async def load_test_post_to_room(args, homeserver: FakeHomeserver, rng: random.Random) -> List[Report]:
+    reports = [Report("post_to_room /notify"), Report("post_to_room /notify/bulk")]
+    config = load_config("post_to_room", homeserver=SERVER_NAME, send_rate=args.send_rate, send_burst=args.send_rate)
+    plugin = PostToRoom(homeserver, asyncio.get_running_loop(), None, "loadtest-post_to_room",
+                        logging.getLogger("loadtest.post_to_room"), config, None, None, None, None)
+    await plugin.start()
+    query = {"secret": config["secret"]}
+    try:
+        # CI announcements go to a small set of rooms, by alias
+        rooms = [f"room-{i}" for i in range(min(50, len(homeserver.room_ids)))]
+        items = [{"room": rng.choice(rooms), "message": f"**Build {n}** {sentence(rng, 10)}"}
+                 for n in range(args.events)]
+
+        report = reports[0]
+        statuses = []
+
+        async def notify(item: dict) -> None:
+            response = await plugin.post_data(FakeRequest(query, item))
+            statuses.append(response.status)
+
+        started = time.perf_counter()
+        await replay(items, notify, args.concurrency, report)
+        report.elapsed = time.perf_counter() - started
+        report.operations = len(items)
+        report.failed = sum(status != 200 for status in statuses)
+        report.note = f"{homeserver.requests.get('resolve_room_alias', 0)} alias lookups"
+
+        report = reports[1]
+        batches = [items[i:i + 100] for i in range(0, len(items), 100)]
+
+        async def notify_bulk(batch: List[dict]) -> None:
+            response = await plugin.post_bulk_data(FakeRequest(query, batch))
+            report.failed += sum(result["status"] != 200 for result in json.loads(response.text))
+
+        started = time.perf_counter()
+        await replay(batches, notify_bulk, max(1, args.concurrency // 10), report)
+        report.elapsed = time.perf_counter() - started
+        report.operations = len(items)
+        report.note = f"{len(batches)} requests of up to 100 messages, latency per request"
+        return reports
+    finally:
+        await plugin.pre_stop()
+        await plugin.stop()
+
+
+# Peak memory allocated by Python while running the load test of one plugin, on top of what was allocated before
+async def measure_memory(load_test: Awaitable) -> List[Report]:
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    reports = await load_test
+    if isinstance(reports, Report):
+        reports = [reports]
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    for report in reports:
+        report.peak_memory = peak
+    return reports
+
+
+async def main(args) -> int:
+    rng = random.Random(args.seed)
+    homeserver = FakeHomeserver(args.rooms, args.homeserver_latency)
+    server = FakeWebhookServer(args.webhook_latency, args.webhook_error_rate,
+                               generate_groups_config(args.groups, rng), rng)
+    await server.start()
+
+    tracemalloc.start()
+    reports = []
+    plugins = args.plugins.split(",")
+    try:
+        with tempfile.TemporaryDirectory() as db_dir:
+            async with aiohttp.ClientSession() as http:
+                if "mentions" in plugins:
+                    reports += await measure_memory(load_test_mentions(args, homeserver, server, http, db_dir, rng))
+                if "relay" in plugins:
+                    reports += await measure_memory(load_test_relay(args, homeserver, server, db_dir, rng))
+                if "watchdog" in plugins:
+                    reports += await measure_memory(load_test_watchdog(args, homeserver, db_dir, rng))
+                if "post_to_room" in plugins:
+                    reports += await measure_memory(load_test_post_to_room(args, homeserver, rng))
+    finally:
+        tracemalloc.stop()
+        await server.stop()
+
+    print(f"\n  {'plugin':<24} {'ops':>7} {'secs':>8} {'ops/sec':>10} {'p50 ms':>8} {'p99 ms':>8} {'peak MB':>8} "
+          f"{'failed':>7}")
+    for report in reports:
+        report.print()
+
+    return 1 if any(report.failed for report in reports) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--plugins", default="mentions,relay,watchdog,post_to_room",
+                        help="comma separated plugins to load test (default: %(default)s)")
+    parser.add_argument("--events", type=int, default=2000,
+                        help="messages replayed through each plugin (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="events or requests handled at the same time (default: %(default)s)")
+    parser.add_argument("--rooms", type=int, default=5000,
+                        help="rooms published in the fake room directory (default: %(default)s)")
+    parser.add_argument("--groups", type=int, default=1000, help="groups in the mentions config (default: %(default)s)")
+    parser.add_argument("--crawls", type=int, default=5, help="room directory crawls by watchdog (default: %(default)s)")
+    parser.add_argument("--changes", type=int, default=20,
+                        help="rooms renamed before each watchdog crawl (default: %(default)s)")
+    parser.add_argument("--homeserver-latency", type=float, default=0.002,
+                        help="secs taken by each fake homeserver request (default: %(default)s)")
+    parser.add_argument("--send-rate", type=float, default=1000,
+                        help="messages per sec allowed by the send scheduler (default: %(default)s)")
+    parser.add_argument("--webhook-latency", type=float, default=0.01,
+                        help="secs taken by each fake webhook request (default: %(default)s)")
+    parser.add_argument("--webhook-error-rate", type=float, default=0.05,
+                        help="share of fake webhook requests failing with 503 (default: %(default)s)")
+    parser.add_argument("--batch-mode", action="store_true", help="relay in batch mode")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="show plugin logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    sys.exit(asyncio.run(main(args)))
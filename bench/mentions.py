@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the Mentions plugin message path.
+
+Generates group configs of increasing size, replays message corpora through `Mentions.handle_message`
+with `client.send_message_event` stubbed out, and reports throughput and latency percentiles.
+No homeserver is needed.
+
+    .venv/bin/python bench/mentions.py
+    .venv/bin/python bench/mentions.py --groups-config plugins/mentions/prod-config.yaml
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from io import StringIO
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins", "mentions"))
+
+from mautrix.types import EventType, MessageEvent, MessageType, RelatesTo, RelationType, TextMessageEventContent
+from ruamel import yaml
+
+from mentions import Mentions
+from wporg_send import get_send_scheduler
+
+ROOM_ID = "!bench:community.wordpress.org"
+WORDS = ["the", "release", "is", "blocked", "on", "review", "please", "take", "a", "look", "at", "this", "patch",
+         "build", "failing", "since", "yesterday", "can", "someone", "from", "help", "with", "tests", "thanks"]
+
+
+class StubClient:
+    mxid = "@mentionsbot:community.wordpress.org"
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message_event(self, room_id, event_type, content):
+        self.sent += 1
+
+
+def generate_groups(count: int, rng: random.Random) -> List[dict]:
+    users = [f"@user{i}:community.wordpress.org" for i in range(max(count * 5, 100))]
+    groups = []
+    for i in range(count):
+        group = {
+            "name": f"Team {i}",
+            "keyword": f"team-{i}",
+            "slack_subteam_id": f"S{i:08d}",
+            "users": rng.sample(users, rng.randint(3, 50)),
+            "quote_triggering_message": rng.random() < 0.5,
+            "always_reply_in_thread": rng.random() < 0.1,
+        }
+        # some groups nest a few earlier ones, like teams made of sub-teams
+        if i > 10 and rng.random() < 0.05:
+            group["groups"] = [f"team-{j}" for j in rng.sample(range(i), 3)]
+        groups.append(group)
+    return groups
+
+
+def generate_corpora(mentions: List[str], count: int, rng: random.Random) -> Dict[str, List[str]]:
+    def sentence(length: int) -> str:
+        return " ".join(rng.choice(WORDS) for _ in range(length))
+
+    return {
+        "no mention": [sentence(20) for _ in range(count)],
+        "single mention": [f"{sentence(8)} {rng.choice(mentions)} {sentence(8)}" for _ in range(count)],
+        "many mentions": [" ".join(f"{sentence(3)} {rng.choice(mentions)}" for _ in range(10)) for _ in range(count)],
+        "long body": [f"{sentence(1000)} {rng.choice(mentions)} {sentence(1000)}" for _ in range(count)],
+    }
+
+
+def make_event(body: str, n: int, in_thread: bool) -> MessageEvent:
+    relates_to = RelatesTo(rel_type=RelationType.THREAD, event_id="$thread-root") if in_thread else None
+    return MessageEvent(
+        type=EventType.ROOM_MESSAGE,
+        room_id=ROOM_ID,
+        event_id=f"$event{n}",
+        sender="@someone:community.wordpress.org",
+        timestamp=0,
+        content=TextMessageEventContent(msgtype=MessageType.TEXT, body=body, relates_to=relates_to),
+    )
+
+
+def percentile(sorted_values: List[int], pct: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run(groups_config: str, label: str, messages: int, rng: random.Random) -> None:
+    client = StubClient()
+    config = {
+        "render_cache_size": 256,
+        "coalesce_window": 0,
+        "coalesce_mode": "drop",
+        "coalesce_cache_size": 10000,
+    }
+    plugin = Mentions(client, asyncio.get_running_loop(), None, "bench", logging.getLogger("bench"), config,
+                      None, None, None, None)
+    # set up by start(), which needs a database; unthrottled, so that only the plugin's own work is measured
+    plugin.send_scheduler = get_send_scheduler(client.mxid, rate=1e9, burst=1_000_000, concurrency=1000)
+
+    started = time.perf_counter()
+    await plugin.apply_config(groups_config)
+    sync_ms = (time.perf_counter() - started) * 1000
+
+    index = plugin.mention_index
+    mentions = ["@" + keyword for keyword in index.groups_by_keyword]
+    mentions += ["!subteam^" + subteam_id for subteam_id in index.groups_by_slack_subteam_id]
+    if not mentions:
+        print(f"{label}: config has no groups")
+        return
+
+    print(f"\n{label}: {len(index.groups)} groups, config sync {sync_ms:.1f} ms")
+    print(f"  {'corpus':<16} {'msgs/sec':>10} {'p50 us':>10} {'p99 us':>10} {'pings':>8}")
+
+    for corpus, bodies in generate_corpora(mentions, messages, rng).items():
+        events = [make_event(body, n, in_thread=n % 4 == 0) for n, body in enumerate(bodies)]
+        sent_before = client.sent
+        latencies = []
+
+        started = time.perf_counter()
+        for evt in events:
+            t0 = time.perf_counter_ns()
+            await plugin.handle_message(evt)
+            latencies.append(time.perf_counter_ns() - t0)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        print(f"  {corpus:<16} {len(events) / elapsed:>10.0f} {percentile(latencies, 50) / 1000:>10.1f} "
+              f"{percentile(latencies, 99) / 1000:>10.1f} {client.sent - sent_before:>8}")
+
+
+async def main(sizes: List[int], messages: int, groups_config_path: Optional[str], seed: int) -> None:
+    rng = random.Random(seed)
+
+    if groups_config_path:
+        with open(groups_config_path) as f:
+            await run(f.read(), groups_config_path, messages, rng)
+        return
+
+    for size in sizes:
+        buffer = StringIO()
+        yaml.YAML(typ="safe").dump({"groups": generate_groups(size, rng)}, buffer)
+        await run(buffer.getvalue(), "synthetic config", messages, rng)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10,1000,10000",
+                        help="comma separated number of groups in synthetic configs (default: %(default)s)")
+    parser.add_argument("--messages", type=int, default=2000,
+                        help="messages replayed per corpus (default: %(default)s)")
+    parser.add_argument("--groups-config", help="benchmark this groups config file instead of synthetic ones")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(main([int(size) for size in args.sizes.split(",")], args.messages, args.groups_config, args.seed))
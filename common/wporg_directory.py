@@ -0,0 +1,272 @@
+# The homeserver's public room directory, crawled once for all plugins using the same Matrix user.
+#
+# This module lives in `common/` and is symlinked into each plugin that uses it, since maubot plugins are built
+# and loaded as separate archives. As for wporg_send, all plugins share the same module, with the globals of the
+# version loaded last, and the directories are kept in the registry of wporg_send, which outlives the reloads and
+# upgrades of the plugins loading this module.
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from mautrix.client import Client
+from mautrix.types import DirectoryPaginationToken, RoomID
+from mautrix.types.misc import PublicRoomInfo
+from wporg_metrics import Histogram
+from wporg_send import get_registry
+
+PAGE_SIZE = 1000
+MAX_RETRIES = 5  # per page
+RETRY_BASE_DELAY = 10  # secs, doubled with each retry
+RETRY_MAX_DELAY = 1800  # secs
+
+
+# Only compared within the same process. Watchdog fingerprints the rooms of its snapshot the same way.
+def get_fingerprint(name: str, topic: str, alias: str) -> int:
+    return hash((name, topic, alias))
+
+
+class DirectoryRoom:
+    __slots__ = ("room_id", "name", "topic", "alias", "aliases", "fingerprint")
+
+    def __init__(self, room_id: RoomID, name: str, topic: Optional[str], alias: str, aliases: Tuple[str, ...] = (),
+                 fingerprint: Optional[int] = None):
+        self.room_id = room_id
+        self.name = name
+        self.topic = topic  # None once the crawl that found it is over
+        self.alias = alias  # canonical alias
+        self.aliases = aliases  # canonical alias first, then alternative aliases
+        self.fingerprint = get_fingerprint(name, topic, alias) if fingerprint is None else fingerprint
+
+    @classmethod
+    def from_public_room_info(cls, room: PublicRoomInfo) -> "DirectoryRoom":
+        alias = room.canonical_alias or ""
+        aliases = (alias,) if alias else ()
+        if room.aliases:
+            aliases = tuple(dict.fromkeys(a for a in (alias, *room.aliases) if a))
+        return cls(room.room_id, room.name or "", room.topic or "", alias, aliases)
+
+    # What's kept between crawls: topics make up most of the directory, and are only needed to report changes
+    def without_topic(self) -> "DirectoryRoom":
+        return DirectoryRoom(self.room_id, self.name, None, self.alias, self.aliases, self.fingerprint)
+
+    def get_key(self) -> Tuple[int, Tuple[str, ...]]:
+        return self.fingerprint, self.aliases
+
+
+# What a crawl found changed since the previous one, given to subscribers.
+# Rooms added and changed rooms as they are now have their topic, removed rooms and changed rooms as they were don't.
+class DirectoryChanges:
+    __slots__ = ("added", "removed", "changed")
+
+    def __init__(self):
+        self.added: List[DirectoryRoom] = []
+        self.removed: List[DirectoryRoom] = []
+        self.changed: List[Tuple[DirectoryRoom, DirectoryRoom]] = []  # (before, after)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+
+# Rooms of the last complete crawl, indexed by room ID, alias and name. Reads never wait for the homeserver.
+# Topics aren't kept, only the fingerprint of the name, topic and canonical alias of each room.
+# While there are subscribers with an interval, the directory is crawled every (shortest) interval. A plugin can
+# also ask for a crawl with `refresh()`, which reuses a recent enough crawl or joins the one in progress.
+class RoomDirectory:
+    def __init__(self, client: Client, log: logging.Logger):
+        self.client = client
+        self.log = log
+        self.rooms: Dict[RoomID, DirectoryRoom] = {}
+        self._by_alias: Dict[str, RoomID] = {}
+        self._by_name: Dict[str, Set[RoomID]] = {}  # lower case name -> room IDs
+        self.crawled_at: Optional[float] = None  # monotonic time the last complete crawl started
+        self.crawls = 0
+        self.failed_crawls = 0
+        self.last_crawl_pages = 0
+        self.page_seconds = Histogram(
+            "wporg_room_directory_page_seconds", "Time taken to fetch a page of the room directory by outcome",
+            ("result",))
+        self._subscribers: Dict[str, Tuple[Optional[float], Optional[Callable]]] = {}  # id -> (interval, callback)
+        self._attempted_at: Optional[float] = None  # monotonic time the last crawl started, complete or not
+        self._crawl: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    # `callback` is called with the DirectoryChanges of each crawl that found any. Subscribers without an interval
+    # get notified of the crawls of others, but don't get the directory crawled.
+    def subscribe(self, subscriber_id: str, interval: Optional[float] = None,
+                  callback: Optional[Callable[[DirectoryChanges], None]] = None) -> None:
+        self._subscribers[subscriber_id] = (interval, callback)
+        if interval is not None and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self.run())
+        self._wakeup.set()
+
+    def unsubscribe(self, subscriber_id: str) -> None:
+        self._subscribers.pop(subscriber_id, None)
+        self._wakeup.set()
+
+    def get_room(self, room_id: RoomID) -> Optional[DirectoryRoom]:
+        return self.rooms.get(room_id)
+
+    def get_room_id_by_alias(self, room_alias: str) -> Optional[RoomID]:
+        return self._by_alias.get(room_alias)
+
+    def get_rooms_by_name(self, name: str) -> List[DirectoryRoom]:
+        return [self.rooms[room_id] for room_id in self._by_name.get(name.lower(), ())]
+
+    # Returns the rooms found by the crawl waited for, with their topic, or None if a recent enough one was reused.
+    # With not_before (monotonic time), only a crawl started since then is reused or waited for.
+    async def refresh(self, max_age: float = 0, max_retries: int = MAX_RETRIES,
+                      not_before: float = 0) -> Optional[Dict[RoomID, DirectoryRoom]]:
+        if (self.crawled_at is not None and self.crawled_at >= not_before
+                and time.monotonic() - self.crawled_at < max_age):
+            return None
+
+        if self._crawl is not None and not self._crawl.done() and self._attempted_at < not_before:
+            # a new crawl is started once this one is over
+            await asyncio.wait([self._crawl])
+
+        if self._crawl is None or self._crawl.done():
+            self._attempted_at = time.monotonic()
+            self._crawl = asyncio.get_running_loop().create_task(self.crawl(max_retries))
+            # so that the rooms it found don't stay in memory until the next crawl
+            self._crawl.add_done_callback(self.forget_crawl)
+        # a caller giving up doesn't cancel the crawl for the others
+        return await asyncio.shield(self._crawl)
+
+    def forget_crawl(self, crawl: asyncio.Task) -> None:
+        if self._crawl is crawl:
+            self._crawl = None
+
+    async def crawl(self, max_retries: int) -> Dict[RoomID, DirectoryRoom]:
+        started = self._attempted_at
+        rooms: Dict[RoomID, DirectoryRoom] = {}
+        pages = 0
+        retries = 0
+        pagination_token = DirectoryPaginationToken("")
+
+        while True:
+            page_started = time.perf_counter()
+            try:
+                directory = await self.client.get_room_directory(
+                    limit=PAGE_SIZE, include_all_networks=False, since=pagination_token
+                )
+            except Exception:
+                self.page_seconds.observe(time.perf_counter() - page_started, "error")
+                if retries >= max_retries:
+                    self.failed_crawls += 1
+                    self.log.exception("failed to query room directory & exhausted max_retries")
+                    raise
+
+                self.log.exception("failed to query room directory but will retry")
+                await asyncio.sleep(min(RETRY_BASE_DELAY * 2 ** retries, RETRY_MAX_DELAY))
+                retries += 1
+                continue
+
+            self.page_seconds.observe(time.perf_counter() - page_started, "ok")
+            retries = 0
+            pages += 1
+            for public_room in directory.chunk:
+                rooms[public_room.room_id] = DirectoryRoom.from_public_room_info(public_room)
+
+            if directory.next_batch is None:
+                break
+            pagination_token = directory.next_batch
+
+        self.crawls += 1
+        self.last_crawl_pages = pages
+        self.crawled_at = started
+        self.update(rooms)
+        return rooms
+
+    def update(self, rooms: Dict[RoomID, DirectoryRoom]) -> None:
+        changes = DirectoryChanges()
+        known_rooms, self.rooms = self.rooms, {}
+        for room_id, room in rooms.items():
+            known_room = known_rooms.get(room_id)
+            if known_room is None:
+                changes.added.append(room)
+            elif known_room.get_key() != room.get_key():
+                changes.changed.append((known_room, room))
+            else:
+                self.rooms[room_id] = known_room
+                continue
+            self.rooms[room_id] = room.without_topic()
+        changes.removed = [room for room_id, room in known_rooms.items() if room_id not in rooms]
+
+        if changes:
+            for room in (*changes.removed, *(before for before, _ in changes.changed)):
+                self.unindex(room)
+            for room in (*changes.added, *(after for _, after in changes.changed)):
+                self.index(room)
+
+            for subscriber_id, (_, callback) in list(self._subscribers.items()):
+                if callback is None:
+                    continue
+                try:
+                    callback(changes)
+                except Exception:
+                    self.log.exception(f"room directory subscriber {subscriber_id} failed to handle changes")
+
+    def index(self, room: DirectoryRoom) -> None:
+        for alias in room.aliases:
+            self._by_alias[alias] = room.room_id
+        self._by_name.setdefault(room.name.lower(), set()).add(room.room_id)
+
+    def unindex(self, room: DirectoryRoom) -> None:
+        for alias in room.aliases:
+            # unless another room claims it now
+            if self._by_alias.get(alias) == room.room_id:
+                del self._by_alias[alias]
+        room_ids = self._by_name.get(room.name.lower())
+        if room_ids is not None:
+            room_ids.discard(room.room_id)
+            if not room_ids:
+                del self._by_name[room.name.lower()]
+
+    def get_interval(self) -> Optional[float]:
+        intervals = [interval for interval, _ in self._subscribers.values() if interval is not None]
+        return min(intervals) if intervals else None
+
+    async def run(self) -> None:
+        while True:
+            interval = self.get_interval()
+            if interval is None:
+                return
+
+            # crawls asked for with refresh() count too, and a failed crawl is only tried again the next interval
+            delay = 0.0 if self._attempted_at is None else self._attempted_at + interval - time.monotonic()
+            if delay > 0:
+                # subscribers may come and go meanwhile, with a shorter interval
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self.refresh(max_age=interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass  # already logged
+
+
+# Bump when RoomDirectory changes in a way that directories created by a previous version of this module can't be used
+# by this one, see SCHEDULERS_VERSION
+DIRECTORIES_VERSION = 1
+
+_directories: Dict[str, RoomDirectory] = get_registry(f"wporg_directory.directories.v{DIRECTORIES_VERSION}")
+
+
+# One directory per Matrix user, as that's who crawls it (it's the same for every user of a homeserver, but
+# plugins using different users may well be configured for different homeservers)
+def get_shared_room_directory(client: Client, log: logging.Logger) -> RoomDirectory:
+    directory = _directories.get(client.mxid)
+    if directory is None:
+        directory = _directories[client.mxid] = RoomDirectory(client, log)
+    else:
+        # the client of a user is replaced when it's reconfigured in maubot
+        directory.client = client
+    return directory
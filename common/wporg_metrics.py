@@ -0,0 +1,147 @@
+# Runtime metrics for plugins, exposed in Prometheus text format.
+#
+# This module lives in `common/` and is symlinked into each plugin that uses it, since maubot plugins are built
+# and loaded as separate archives. Each plugin instance keeps its own Metrics and serves them from its web app.
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from aiohttp.web import Request, Response
+
+# secs, from a fast dict lookup to a slow homeserver or webhook
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values: Dict[Tuple[str, ...], float] = {} if label_names else {(): 0}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+
+# Buckets are fixed when the histogram is created, so observing a value is a bisect and two additions
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}  # label values -> (counts, [sum])
+
+    def observe(self, value: float, *label_values: str) -> None:
+        values = self.values.get(label_values)
+        if values is None:
+            values = self.values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        values[0][bisect_left(self.buckets, value)] += 1
+        values[1][0] += value
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, f'le="{format_value(bucket)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total[0])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# Value read when metrics are rendered, for numbers the plugin already keeps track of (e.g. queue depth)
+class Callback:
+    def __init__(self, name: str, documentation: str, metric_type: str,
+                 callback: Callable[[], Union[float, Dict[Tuple[str, ...], float]]], label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.callback = callback
+        self.label_names = label_names
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, label_names, buckets))
+
+    def gauge_callback(self, name: str, documentation: str, callback: Callable, label_names=()) -> Callback:
+        return self._add(Callback(name, documentation, "gauge", callback, label_names))
+
+    def counter_callback(self, name: str, documentation: str, callback: Callable, label_names=()) -> Callback:
+        return self._add(Callback(name, documentation, "counter", callback, label_names))
+
+    # for a metric shared by several plugin instances, e.g. one kept by a module in `common/`
+    def add(self, metric):
+        return self._add(metric)
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    # For a plugin's `@web.get("/metrics")` handler, an empty secret allows anyone to read the metrics
+    def response(self, request: Request, secret: Optional[str]) -> Response:
+        if secret and request.rel_url.query.get("secret") != secret:
+            return Response(status=403)
+
+        return Response(text=self.render(), headers={"Content-Type": CONTENT_TYPE})
@@ -0,0 +1,208 @@
+# Flow control for messages sent to Matrix, shared by all plugins sending as the same Matrix user.
+#
+# This module lives in `common/` and is symlinked into each plugin that uses it, since maubot plugins are built
+# and loaded as separate archives. There's only one `wporg_send` module in the process though: maubot runs the code of
+# each plugin loading it again in the module already in `sys.modules`, so its globals are those of the version loaded
+# last, for the functions of plugins loaded before as well. maubot also deletes it from `sys.modules` when the plugin
+# that loaded it last is reloaded or upgraded, so the schedulers are kept in a registry that outlives it.
+import asyncio
+import random
+import sys
+import time
+import types
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from mautrix.errors import MLimitExceeded
+
+# Messages of a higher priority are always sent first, e.g. mention pings before a watchdog digest
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Used when the homeserver doesn't tell how long to wait (mautrix doesn't keep `retry_after_ms` as of 0.20)
+DEFAULT_RETRY_AFTER = 1.0  # secs, doubled with each retry
+MAX_RETRY_AFTER = 60.0  # secs
+MAX_RATE_LIMITED_RETRIES = 8
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    # secs to wait before a token is available
+    def get_delay(self) -> float:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    # the homeserver rate limits per user, so nothing is sent until it allows it again
+    def pause(self, delay: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.tokens = 0.0
+        self.updated_at = self.paused_until
+
+
+class SendJob:
+    __slots__ = ("send", "priority", "future", "attempts")
+
+    def __init__(self, send: Callable[[], Awaitable[Any]], priority: int, future: asyncio.Future):
+        self.send = send
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+
+
+# Messages to a room are sent one at a time and in order, up to `concurrency` rooms at the same time.
+# The next room to send to is taken from the highest priority lane that isn't empty, a room is in the lane
+# of the priority of its next message.
+class SendScheduler:
+    def __init__(self, rate: float, burst: int, concurrency: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.sent = 0
+        self.rate_limited = 0
+        self._rooms: Dict[str, Deque[SendJob]] = {}  # room_id -> messages waiting or being sent, oldest first
+        self._lanes: List[Deque[str]] = [deque() for _ in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)]
+        self._in_flight = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def configure(self, rate: float, burst: int, concurrency: int) -> None:
+        self.bucket.rate = rate
+        self.bucket.burst = burst
+        self.concurrency = concurrency
+
+    def get_queue_depth(self) -> int:
+        return sum(len(jobs) for jobs in self._rooms.values())
+
+    # Returns what `send` returns (e.g. the event ID) once the message has been sent
+    async def send(self, room_id: str, send: Callable[[], Awaitable[Any]], priority: int = PRIORITY_NORMAL) -> Any:
+        job = SendJob(send, priority, asyncio.get_running_loop().create_future())
+        jobs = self._rooms.get(room_id)
+        if jobs is None:
+            self._rooms[room_id] = deque([job])
+            self._lanes[priority].append(room_id)
+        else:
+            # the room gets back in a lane once the messages before this one are sent
+            jobs.append(job)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.dispatch())
+        self._wakeup.set()
+        return await job.future
+
+    # Returns the room along with the lane it's in, which isn't that of the priority of its next message if the messages
+    # before it were skipped
+    def get_next_room(self) -> Optional[Tuple[str, Deque[str]]]:
+        for lane in self._lanes:
+            while lane:
+                room_id = lane[0]
+                jobs = self._rooms[room_id]
+                # skip messages whose sender has given up waiting
+                while jobs and jobs[0].future.done():
+                    jobs.popleft()
+                if jobs:
+                    return room_id, lane
+                lane.popleft()
+                del self._rooms[room_id]
+        return None
+
+    async def dispatch(self) -> None:
+        while True:
+            next_room = self.get_next_room() if self._in_flight < self.concurrency else None
+            if next_room is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self.bucket.get_delay()
+            if delay > 0:
+                # a message of higher priority may come in meanwhile, so the room is picked again afterwards
+                await asyncio.sleep(delay)
+                continue
+
+            self.bucket.take()
+            room_id, lane = next_room
+            lane.popleft()
+            self._in_flight += 1
+            asyncio.get_running_loop().create_task(self.run(room_id, self._rooms[room_id][0]))
+
+    async def run(self, room_id: str, job: SendJob) -> None:
+        retry = False
+        try:
+            job.attempts += 1
+            result = await job.send()
+        except MLimitExceeded as e:
+            self.rate_limited += 1
+            retry_after = getattr(e, "retry_after_ms", None)
+            if retry_after:
+                delay = retry_after / 1000
+            else:
+                delay = min(DEFAULT_RETRY_AFTER * 2 ** (job.attempts - 1), MAX_RETRY_AFTER)
+                delay = random.uniform(delay / 2, delay)
+            self.bucket.pause(delay)
+            retry = job.attempts <= MAX_RATE_LIMITED_RETRIES
+            if not retry and not job.future.done():
+                job.future.set_exception(e)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._in_flight -= 1
+            jobs = self._rooms[room_id]
+            if not retry:
+                jobs.popleft()
+
+            if not jobs:
+                del self._rooms[room_id]
+            elif retry:
+                # ahead of other rooms, it was its turn already
+                self._lanes[jobs[0].priority].appendleft(room_id)
+            else:
+                self._lanes[jobs[0].priority].append(room_id)
+            self._wakeup.set()
+
+
+# Bump when SendScheduler changes in a way that schedulers created by a previous version of this module can't be used
+# by this one. Plugin instances started from then on get new schedulers, whichever version of this module they were
+# built with (their code runs with the globals of the version loaded last, so get_send_scheduler() and what plugins use
+# of SendScheduler must stay compatible), while instances started before keep the old ones until they're restarted.
+SCHEDULERS_VERSION = 1
+
+
+# A module maubot never unloads, as it isn't loaded from any plugin archive
+def get_registry(name: str) -> dict:
+    registry = sys.modules.get("wporg_registry")
+    if registry is None:
+        registry = sys.modules["wporg_registry"] = types.ModuleType("wporg_registry")
+    return registry.__dict__.setdefault(name, {})
+
+
+_schedulers: Dict[str, SendScheduler] = get_registry(f"wporg_send.schedulers.v{SCHEDULERS_VERSION}")
+
+
+# One scheduler per Matrix user, as the homeserver rate limits per user.
+# Settings are those of the plugin instance that asked for it last.
+def get_send_scheduler(user_id: str, rate: float, burst: int, concurrency: int) -> SendScheduler:
+    scheduler = _schedulers.get(user_id)
+    if scheduler is None:
+        scheduler = _schedulers[user_id] = SendScheduler(rate, burst, concurrency)
+    else:
+        scheduler.configure(rate, burst, concurrency)
+    return scheduler
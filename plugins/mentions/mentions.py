@@ -1,18 +1,46 @@
 import asyncio
-import aiohttp
 import re
+import time
+from collections import OrderedDict
+from aiohttp.web import Request, Response
 from maubot import Plugin, MessageEvent
-from maubot.handlers import event
+from maubot.handlers import event, web
 from mautrix.types import EventType
-from typing import List, Tuple, Type
+from typing import Dict, Iterable, List, Optional, Tuple, Type
 from ruamel import yaml
+from mautrix.util.async_db import UpgradeTable, Connection
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
+from wporg_metrics import Metrics
+from wporg_send import PRIORITY_HIGH, get_send_scheduler
 
 
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("groups_config_src")
         helper.copy("sync_config_interval")
+        helper.copy("render_cache_size")
+        helper.copy("coalesce_window")
+        helper.copy("coalesce_mode")
+        helper.copy("coalesce_cache_size")
+        helper.copy("metrics_secret")
+        helper.copy("send_rate")
+        helper.copy("send_burst")
+        helper.copy("send_concurrency")
+
+
+upgrade_table = UpgradeTable()
+
+
+@upgrade_table.register(description="Store last known-good groups config")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE groups_config (
+            src           TEXT NOT NULL,
+            etag          TEXT NOT NULL,
+            last_modified TEXT NOT NULL,
+            body          TEXT NOT NULL
+        )"""
+    )
 
 
 # returns default bool if all elements in boolList are not same
@@ -26,11 +54,201 @@ def get_collective_behavior(boolList: List[bool], default: bool) -> bool:
         return default
 
 
+# mentions in a thread are coalesced separately from those in the main timeline of the room
+def get_thread_root(evt: MessageEvent) -> str:
+    if str(evt.content.relates_to.rel_type) == "m.thread":
+        return evt.content.relates_to.event_id
+    return ""
+
+
+def render_plain_users(users: Iterable[str]) -> str:
+    return ", ".join(users)
+
+
+def render_html_users(users: Iterable[str]) -> str:
+    return "".join(" <a href='https://matrix.to/#/" + user + "'>" + user + "</a>" for user in users)
+
+
+# A plain alternation of thousands of mentions is tried one alternative at a time at every `@` in a message,
+# so the alternation is factored into a trie instead: matching cost depends on the length of the mention,
+# not on the number of groups. Longest mention wins, so that `@core-editor` doesn't match as `@core`.
+def build_trie_pattern(words: Iterable[str]) -> str:
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}  # end of a word
+
+    def to_pattern(node: dict) -> str:
+        branches = [re.escape(char) + to_pattern(child) for char, child in node.items() if char]
+        if not branches:
+            return ''
+
+        is_word_end = '' in node
+        if len(branches) == 1 and not is_word_end:
+            return branches[0]
+
+        pattern = '(?:' + '|'.join(branches) + ')'
+        return pattern + '?' if is_word_end else pattern
+
+    return to_pattern(trie)
+
+
+class MentionGroup:
+    __slots__ = ("position", "name", "keyword", "slack_subteam_id", "own_users", "subgroups",
+                 "users", "plain_users", "html_users", "quote_triggering_message", "always_reply_in_thread")
+
+    def __init__(self, position: int, group: dict):
+        self.position = position  # order in which the group appears in config
+        self.name = group['name']
+        self.keyword = group['keyword']
+        self.slack_subteam_id = group.get('slack_subteam_id') or ""
+        self.own_users = tuple(group.get('users') or [])
+        self.subgroups = tuple(group.get('groups') or [])  # keywords of nested groups
+        self.quote_triggering_message = bool(group.get('quote_triggering_message', True))
+        self.always_reply_in_thread = bool(group.get('always_reply_in_thread', False))
+
+        # members including those of nested groups, set by MentionIndex once all groups are known
+        self.users = None
+        self.plain_users = None
+        self.html_users = None
+
+    def set_users(self, users: Tuple[str, ...]) -> None:
+        self.users = users
+
+        # pre-rendered parts of the ping message
+        self.plain_users = render_plain_users(users)
+        self.html_users = render_html_users(users)
+
+
+# Built once per config sync and never mutated afterwards, so it can be swapped in atomically
+class MentionIndex:
+    def __init__(self, groups: List[dict], render_cache_size: int = 256):
+        self.groups = tuple(MentionGroup(position, group) for position, group in enumerate(groups))
+        self.groups_by_keyword: Dict[str, MentionGroup] = {}
+        self.groups_by_slack_subteam_id: Dict[str, MentionGroup] = {}
+
+        for group in self.groups:
+            self.groups_by_keyword.setdefault(group.keyword, group)
+            if group.slack_subteam_id:
+                self.groups_by_slack_subteam_id.setdefault(group.slack_subteam_id, group)
+
+        for group in self.groups:
+            self.resolve_users(group, [])
+
+        possible_mentions = ['@' + keyword for keyword in self.groups_by_keyword]
+        possible_mentions += ['!subteam^' + subteam_id for subteam_id in self.groups_by_slack_subteam_id]
+
+        self.pattern = None
+        if possible_mentions:
+            self.pattern = re.compile(build_trie_pattern(possible_mentions))
+
+        # LRU of rendered message content, keyed by positions of mentioned groups
+        self._rendered = OrderedDict()
+        self._render_cache_size = render_cache_size
+
+    # flattens users of a group and all of its nested groups, depth first
+    def resolve_users(self, group: MentionGroup, resolving: List[str]) -> Tuple[str, ...]:
+        if group.users is not None:
+            return group.users
+
+        if group.keyword in resolving:
+            raise ValueError("cycle in nested groups: " + " -> ".join(resolving + [group.keyword]))
+
+        resolving.append(group.keyword)
+        users = list(group.own_users)
+        for keyword in group.subgroups:
+            subgroup = self.groups_by_keyword.get(keyword)
+            if subgroup is None:
+                raise ValueError(f"group {group.keyword} references unknown group {keyword}")
+            users.extend(self.resolve_users(subgroup, resolving))
+        resolving.pop()
+
+        group.set_users(tuple(dict.fromkeys(users)))
+        return group.users
+
+    def find(self, text: str) -> List[str]:
+        if self.pattern is None:
+            return []
+        return self.pattern.findall(text)
+
+    def get_group(self, match: str) -> Optional[MentionGroup]:
+        if match.startswith('!subteam^'):
+            return self.groups_by_slack_subteam_id.get(match[len('!subteam^'):])
+        return self.groups_by_keyword.get(match)
+
+    # groups must be sorted by position
+    def render(self, groups: Tuple[MentionGroup, ...]) -> dict:
+        key = tuple(group.position for group in groups)
+
+        template = self._rendered.get(key)
+        if template is not None:
+            self._rendered.move_to_end(key)
+            return dict(template)
+
+        if len(groups) == 1:
+            users = groups[0].users
+            plain_users = groups[0].plain_users
+            html_users = groups[0].html_users
+        else:
+            users = tuple(dict.fromkeys(user for group in groups for user in group.users))
+            plain_users = render_plain_users(users)
+            html_users = render_html_users(users)
+
+        prefix = "Pinging members of " + ', '.join(dict.fromkeys(group.name for group in groups)) + ": "
+        template = {
+            "body": prefix + plain_users,
+            "format": "org.matrix.custom.html",
+            "formatted_body": prefix + html_users,
+            "m.mentions": {
+                "user_ids": list(users)
+            },
+            "msgtype": "m.notice",
+        }
+
+        self._rendered[key] = template
+        if len(self._rendered) > self._render_cache_size:
+            self._rendered.popitem(last=False)
+
+        return dict(template)
+
+
+# CPU bound, meant to be run in an executor so that big configs don't block the event loop
+def parse_groups_config(text: str, render_cache_size: int) -> Tuple[dict, MentionIndex]:
+    configured_groups = yaml.YAML(typ="safe").load(text)
+    if not isinstance(configured_groups, dict) or not isinstance(configured_groups.get("groups"), list):
+        raise ValueError("config must have a list of groups")
+
+    return configured_groups, MentionIndex(configured_groups["groups"], render_cache_size)
+
+
 class Mentions(Plugin):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.sync_config_task = None  # hold sync task object
         self.configured_groups = None  # synced from external src
+        self.mention_index = None  # derived from configured_groups on every sync
+        self._config_src = None  # src, ETag & Last-Modified of the current config, for conditional fetch
+        self._config_etag = ""
+        self._config_last_modified = ""
+        self._config_body = None
+        self._recent_mentions = OrderedDict()  # (room_id, thread_root) -> {group keyword: expires at}
+        self._pending_mentions = {}  # (room_id, thread_root) -> (first event, matches), for merge mode
+        self._flush_tasks = set()
+
+        self.send_scheduler = None
+
+        self.metrics = Metrics()
+        self.handle_message_seconds = self.metrics.histogram(
+            "mentions_handle_message_seconds", "Time taken to handle a room message, including sending the ping")
+        self.pings_total = self.metrics.counter(
+            "mentions_pings_total", "Mentions of groups by outcome", ("result",))
+        self.config_sync_seconds = self.metrics.histogram(
+            "mentions_config_sync_seconds", "Time taken to sync groups config by outcome", ("result",))
+        self.metrics.gauge_callback(
+            "mentions_groups", "Number of configured groups",
+            lambda: len(self.mention_index.groups) if self.mention_index else 0)
 
     def get_command_name(self) -> str:
         return self.id
@@ -39,9 +257,22 @@ class Mentions(Plugin):
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
 
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
+
     async def start(self) -> None:
         await super().start()
         self.config.load_and_update()
+        self.send_scheduler = get_send_scheduler(
+            self.client.mxid, self.config["send_rate"], self.config["send_burst"], self.config["send_concurrency"]
+        )
+
+        # serve mentions right away with the last known-good config, sync will catch up with src
+        try:
+            await self.load_saved_config()
+        except Exception:
+            self.log.exception("failed to load saved config")
 
         # Don't forget to cancel the task, when stopping
         self.sync_config_task = self.loop.create_task(self.sync_config())
@@ -50,76 +281,135 @@ class Mentions(Plugin):
         if self.sync_config_task is not None and not self.sync_config_task.done():
             self.sync_config_task.cancel()
 
+        # don't hold back merged mentions until the window ends
+        for task in self._flush_tasks:
+            task.cancel()
+        for key in list(self._pending_mentions):
+            await self.flush_mentions(key)
+
+    # Available at $MAUBOT_URL/_matrix/maubot/plugin/<instance ID>/metrics
+    @web.get("/metrics")
+    async def get_metrics(self, request: Request) -> Response:
+        return self.metrics.response(request, self.config["metrics_secret"])
+
     async def sync_config(self):
         while True:
-            src = self.config["groups_config_src"]
-            if not src:
-                self.log.error("missing config src")
-                await asyncio.sleep(self.config["sync_config_interval"])
-                continue
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get(src) as response:
-                    if response.status == 200:
-                        self.configured_groups = yaml.safe_load(await response.text())
-                    else:
-                        self.log.error(f"could not fetch config from src, status={response.status}")
+            started = time.perf_counter()
+            result = "error"
+            try:
+                result = await self.fetch_config()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("failed to sync config")
+            self.config_sync_seconds.observe(time.perf_counter() - started, result)
             await asyncio.sleep(self.config["sync_config_interval"])
 
+    # returns the outcome of the sync, for metrics
+    async def fetch_config(self) -> str:
+        src = self.config["groups_config_src"]
+        if not src:
+            self.log.error("missing config src")
+            return "error"
+
+        headers = {}
+        if src == self._config_src:
+            if self._config_etag:
+                headers["If-None-Match"] = self._config_etag
+            if self._config_last_modified:
+                headers["If-Modified-Since"] = self._config_last_modified
+
+        async with self.http.get(src, headers=headers) as response:
+            if response.status == 304:
+                return "not_modified"
+            if response.status != 200:
+                self.log.error(f"could not fetch config from src, status={response.status}")
+                return "error"
+            body = await response.text()
+            etag = response.headers.get("ETag", "")
+            last_modified = response.headers.get("Last-Modified", "")
+
+        if body != self._config_body:
+            await self.apply_config(body)
+        elif (src, etag, last_modified) == (self._config_src, self._config_etag, self._config_last_modified):
+            # src doesn't support conditional requests, but nothing changed
+            return "not_modified"
+
+        self._config_src = src
+        self._config_etag = etag
+        self._config_last_modified = last_modified
+        await self.save_config(src, etag, last_modified, body)
+        return "updated"
+
+    async def apply_config(self, body: str) -> None:
+        configured_groups, mention_index = await self.loop.run_in_executor(
+            None, parse_groups_config, body, self.config["render_cache_size"]
+        )
+
+        self.mention_index = mention_index
+        self.configured_groups = configured_groups
+        self._config_body = body
+
+    async def load_saved_config(self) -> None:
+        row = await self.database.fetchrow("SELECT src, etag, last_modified, body FROM groups_config")
+        if row is None:
+            return
+
+        await self.apply_config(row["body"])
+        self._config_src = row["src"]
+        self._config_etag = row["etag"]
+        self._config_last_modified = row["last_modified"]
+        self.log.info(f"loaded saved config with {len(self.mention_index.groups)} groups")
+
+    async def save_config(self, src: str, etag: str, last_modified: str, body: str) -> None:
+        async with self.database.acquire() as conn, conn.transaction():
+            await conn.execute("DELETE FROM groups_config")
+            await conn.execute(
+                "INSERT INTO groups_config (src, etag, last_modified, body) VALUES ($1, $2, $3, $4)",
+                src, etag, last_modified, body
+            )
+
     def get_groups(self) -> str:
         return self.configured_groups["groups"]
 
     def get_mentioned_groups(self, text) -> List[str]:
         mentioned_groups = []
 
-        # build regex to search for all group names
-        possible_mentions = []
-        for group in self.get_groups():
-            possible_mentions.append('@' + group['keyword'])
-            possible_mentions.append('!subteam^' + group['slack_subteam_id'])
+        if self.mention_index is None:
+            return mentioned_groups
 
-        specific_mentions_regex = '|'.join(re.escape(possible_mention) for possible_mention in possible_mentions)
-        pattern = f'({specific_mentions_regex})'
-
-        matches = re.findall(pattern, text)
-        for match in matches:
+        for match in self.mention_index.find(text):
             if match[0] == '@':
-                mentioned_groups.append(match.split('@')[1])
+                mentioned_groups.append(match[1:])
             else:
                 mentioned_groups.append(match)
 
         return mentioned_groups
 
-    def get_info_on_matches(self, matches: List[str]) -> Tuple[List[str], List[str], bool, bool]:
-        group_names = {}
-        users_to_notify = {}
+    def get_info_on_matches(self, matches: List[str]) -> Tuple[Tuple[MentionGroup, ...], bool, bool]:
+        index = self.mention_index
+        groups = {}
 
-        # choosing behavior
-        quote_triggering_message = []
-        always_reply_in_thread = []
-
-        for group in self.get_groups():
-            for match in matches:
-                keyword_match = group['keyword'] == match
-                slack_subteam_match = match[0] == '!' and match.split("^")[1] == group['slack_subteam_id']
-
-                if keyword_match or slack_subteam_match:
-                    group_names[group['name']] = True
-                    for user in group['users']:
-                        users_to_notify[user] = True
+        for match in matches:
+            group = index.get_group(match)
+            if group is not None:
+                groups[group.position] = group
 
-                    quote_triggering_message.append(bool(group['quote_triggering_message']))
-                    always_reply_in_thread.append(bool(group['always_reply_in_thread']))
+        # keep the order in which groups are configured
+        mentioned_groups = tuple(groups[position] for position in sorted(groups))
 
         return (
-            list(users_to_notify.keys()),
-            list(group_names.keys()),
-            get_collective_behavior(quote_triggering_message, True),
-            get_collective_behavior(always_reply_in_thread, False),
+            mentioned_groups,
+            get_collective_behavior([group.quote_triggering_message for group in mentioned_groups], True),
+            get_collective_behavior([group.always_reply_in_thread for group in mentioned_groups], False),
         )
 
     @event.on(EventType.ROOM_MESSAGE)
     async def handle_message(self, evt: MessageEvent) -> None:
+        with self.handle_message_seconds.time():
+            await self.process_message(evt)
+
+    async def process_message(self, evt: MessageEvent) -> None:
         # Ignore messages sent by the bot
         if evt.sender == self.client.mxid:
             return
@@ -134,22 +424,34 @@ class Mentions(Plugin):
         if not matches:
             return
 
+        if self.config["coalesce_window"]:
+            if self.config["coalesce_mode"] == "merge":
+                self.pings_total.inc("merged")
+                self.merge_mentions(evt, matches)
+                return
+
+            matches = self.drop_recent_mentions(evt, matches)
+            if not matches:
+                self.pings_total.inc("dropped")
+                return
+
+        await self.ping(evt, matches)
+
+    async def ping(self, evt: MessageEvent, matches: List[str]) -> None:
         # add do_not_bridge property to event so that slack bridge should not carry it over to Slack
         slack_bridge_ignore = False
         for match in matches:
             if match.startswith("!subteam^"):
                 slack_bridge_ignore = True
 
-        # collect group names & users to notify
-        users_to_notify, group_names, quote_triggering_message, always_reply_in_thread = self.get_info_on_matches(
-            matches
-        )
+        # collect groups to notify
+        groups, quote_triggering_message, always_reply_in_thread = self.get_info_on_matches(matches)
+        if not groups:
+            # groups were removed from config while mentions were being merged
+            return
 
-        # construct body and formatted_body for message
-        body = formatted_body = "Pinging members of " + ', '.join(group_names) + ": "
-        body += ", ".join(users_to_notify)
-        for user in users_to_notify:
-            formatted_body = formatted_body + " <a href='https://matrix.to/#/" + user + "'>" + user + "</a>"
+        # body, formatted_body & mentioned users for the message
+        content = self.mention_index.render(groups)
 
         options = {
             "slack_bridge_ignore": slack_bridge_ignore,
@@ -158,28 +460,68 @@ class Mentions(Plugin):
             "event": evt
         }
 
-        await self.notify_users(users_to_notify, body, formatted_body, options)
+        await self.notify_users(content, options)
+
+    # "drop" mode: groups already pinged in the same room/thread within the window are not pinged again
+    def drop_recent_mentions(self, evt: MessageEvent, matches: List[str]) -> List[str]:
+        now = time.monotonic()
+        key = (evt.room_id, get_thread_root(evt))
+
+        recent = self._recent_mentions.pop(key, {})
+        recent = {keyword: expires_at for keyword, expires_at in recent.items() if expires_at > now}
+
+        fresh_matches = []
+        pinged_now = set()
+        for match in matches:
+            group = self.mention_index.get_group(match)
+            if group is None or (group.keyword in recent and group.keyword not in pinged_now):
+                continue
+            recent[group.keyword] = now + self.config["coalesce_window"]
+            pinged_now.add(group.keyword)
+            fresh_matches.append(match)
 
-    async def notify_users(self, users: List[str], body: str, formatted_body: str, options: dict):
+        # re-inserting keeps the most recently active rooms/threads at the end
+        self._recent_mentions[key] = recent
+        while len(self._recent_mentions) > self.config["coalesce_cache_size"]:
+            self._recent_mentions.popitem(last=False)
+
+        return fresh_matches
+
+    # "merge" mode: mentions in the same room/thread are held for the window and sent as one notice,
+    # quoting the first message that triggered it
+    def merge_mentions(self, evt: MessageEvent, matches: List[str]) -> None:
+        key = (evt.room_id, get_thread_root(evt))
+
+        if key in self._pending_mentions:
+            self._pending_mentions[key][1].extend(matches)
+            return
+
+        self._pending_mentions[key] = (evt, list(matches))
+        task = self.loop.create_task(self.flush_mentions_later(key, self.config["coalesce_window"]))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def flush_mentions_later(self, key: Tuple[str, str], delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.flush_mentions(key)
+
+    async def flush_mentions(self, key: Tuple[str, str]) -> None:
+        pending = self._pending_mentions.pop(key, None)
+        if pending is None:
+            return
+
+        evt, matches = pending
+        await self.ping(evt, matches)
+
+    async def notify_users(self, content: dict, options: dict):
         evt = options['event']
 
-        content = {
-            "body": body,
-            "format": "org.matrix.custom.html",
-            "formatted_body": formatted_body,
-            "m.mentions": {
-                "user_ids": users
-            },
-            "msgtype": "m.notice",
-            "m.relates_to": {
+        if options['quote_triggering_message']:
+            content["m.relates_to"] = {
                 "m.in_reply_to": {
                     "event_id": evt.event_id
                 }
             }
-        }
-
-        if not options['quote_triggering_message']:
-            del content['m.relates_to']
 
         if options['slack_bridge_ignore']:
             content["org.wordpress.slack_bridge_ignore"] = options['slack_bridge_ignore']
@@ -197,10 +539,13 @@ class Mentions(Plugin):
             }
 
         try:
-            await self.client.send_message_event(
+            # pings go before any other message waiting to be sent
+            await self.send_scheduler.send(evt.room_id, lambda: self.client.send_message_event(
                 room_id=evt.room_id,
                 event_type=EventType.ROOM_MESSAGE,
                 content=content
-            )
+            ), PRIORITY_HIGH)
+            self.pings_total.inc("sent")
         except Exception as e:
+            self.pings_total.inc("failed")
             self.log.exception("failed to notify users")
@@ -0,0 +1 @@
+../../common/wporg_send.py
\ No newline at end of file
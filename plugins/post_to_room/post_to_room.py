@@ -1,22 +1,84 @@
 from maubot import Plugin
 from maubot.handlers import web
-from aiohttp.web import Request, Response
+from maubot.matrix import parse_formatted
+from aiohttp.web import Request, Response, json_response
+from mautrix.errors import MNotFound
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
-from mautrix.types import RoomID, RoomAlias
-from typing import Type
+from mautrix.types import Format, MessageType, RoomID, RoomAlias, TextMessageEventContent
+from typing import Awaitable, Callable, Dict, List, Optional, Type
+from collections import OrderedDict
+import asyncio
 import json
+import time
+import uuid
+from wporg_directory import DirectoryChanges, get_shared_room_directory
+from wporg_metrics import Metrics
+from wporg_send import get_send_scheduler
 
 
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("secret")
         helper.copy("homeserver")
+        helper.copy("bulk_concurrency")
+        helper.copy("bulk_max_items")
+        helper.copy("alias_cache_size")
+        helper.copy("alias_cache_ttl")
+        helper.copy("alias_negative_cache_ttl")
+        helper.copy("prewarm_alias_cache")
+        helper.copy("async_mode")
+        helper.copy("async_workers")
+        helper.copy("async_queue_size")
+        helper.copy("job_retention")
+        helper.copy("max_jobs")
+        helper.copy("send_rate")
+        helper.copy("send_burst")
+        helper.copy("send_concurrency")
+
+
+# A message accepted by /notify in async mode, delivered by a worker
+class Job:
+    __slots__ = ("job_id", "room", "message", "idempotency_key", "state", "event_id", "error", "finished_at")
+
+    def __init__(self, room: str, message: str, idempotency_key: Optional[str]):
+        self.job_id = uuid.uuid4().hex
+        self.room = room
+        self.message = message
+        self.idempotency_key = idempotency_key
+        self.state = "queued"  # then "sending", then "sent" or "failed"
+        self.event_id = None
+        self.error = None
+        self.finished_at = None  # monotonic time
+
+    def serialize(self) -> Dict:
+        return {"job_id": self.job_id, "state": self.state, "event_id": self.event_id, "error": self.error}
 
 
 class PostToRoom(Plugin):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._cached_resolved_room_aliases = {}
+        self._cached_resolved_room_aliases = OrderedDict()  # room alias -> (expires at, room_id or None if not found)
+        self._room_alias_lookups = {}  # room alias -> in-flight lookup task, so an alias is only resolved once
+        self.room_directory = None  # shared by all plugins using the same Matrix user
+        self.send_scheduler = None
+        self._async_mode = False  # as configured on start, as are the workers
+        self._job_queues: List[asyncio.Queue] = []  # one per worker, a room always maps to the same worker
+        self._job_workers: List[asyncio.Task] = []
+        self._jobs = {}  # job_id -> Job
+        self._finished_jobs = OrderedDict()  # job_id -> Job, in the order they finished, only these are forgotten
+        self._idempotency_keys = {}  # Idempotency-Key header -> job_id
+
+        self.metrics = Metrics()
+        self.notify_seconds = self.metrics.histogram(
+            "post_to_room_notify_seconds", "Time taken to handle a request by endpoint and response status",
+            ("endpoint", "status"))
+        self.metrics.gauge_callback("post_to_room_cached_room_aliases", "Number of resolved room aliases cached",
+                                    lambda: len(self._cached_resolved_room_aliases))
+        self.alias_lookups_total = self.metrics.counter(
+            "post_to_room_alias_lookups_total", "Room alias lookups by result", ("result",))
+        self.metrics.gauge_callback("post_to_room_queued_jobs", "Number of jobs waiting to be delivered",
+                                    lambda: sum(queue.qsize() for queue in self._job_queues))
+        self.jobs_total = self.metrics.counter("post_to_room_jobs_total", "Finished jobs by state", ("state",))
 
     def get_command_name(self) -> str:
         return self.id
@@ -28,6 +90,33 @@ class PostToRoom(Plugin):
     async def start(self) -> None:
         await super().start()
         self.config.load_and_update()
+        self.send_scheduler = get_send_scheduler(
+            self.client.mxid, self.config["send_rate"], self.config["send_burst"], self.config["send_concurrency"]
+        )
+
+        # aliases of published rooms need no lookup, whichever plugin had the room directory crawled
+        self.room_directory = get_shared_room_directory(self.client, self.log)
+        interval = self.config["alias_cache_ttl"] if self.config["prewarm_alias_cache"] else None
+        self.room_directory.subscribe(self.id, interval, self.handle_directory_changes)
+
+        self._async_mode = self.config["async_mode"]
+        if self._async_mode:
+            workers = max(1, self.config["async_workers"])
+            self._job_queues = [asyncio.Queue(maxsize=self.config["async_queue_size"]) for _ in range(workers)]
+            self._job_workers = [self.loop.create_task(self.deliver_jobs(queue)) for queue in self._job_queues]
+
+    async def pre_stop(self) -> None:
+        if self.room_directory is not None:
+            self.room_directory.unsubscribe(self.id)
+
+    async def stop(self) -> None:
+        for worker in self._job_workers:
+            worker.cancel()
+        await asyncio.gather(*self._job_workers, return_exceptions=True)
+
+        queued = sum(queue.qsize() for queue in self._job_queues)
+        if queued:
+            self.log.warning(f"stopping with {queued} jobs not delivered, they are lost")
 
     def get_secret_from_config(self) -> str:
         return self.config["secret"]
@@ -38,6 +127,41 @@ class PostToRoom(Plugin):
     # Available at $MAUBOT_URL/_matrix/maubot/plugin/<instance ID>/notify
     @web.post("/notify")
     async def post_data(self, request: Request) -> Response:
+        return await self.handle_timed("notify", self.notify, request)
+
+    # Available at $MAUBOT_URL/_matrix/maubot/plugin/<instance ID>/notify/bulk
+    @web.post("/notify/bulk")
+    async def post_bulk_data(self, request: Request) -> Response:
+        return await self.handle_timed("notify_bulk", self.notify_bulk, request)
+
+    async def handle_timed(self, endpoint: str, handler: Callable[[Request], Awaitable[Response]],
+                           request: Request) -> Response:
+        started = time.perf_counter()
+        status = 500  # unless a response is returned
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        finally:
+            self.notify_seconds.observe(time.perf_counter() - started, endpoint, str(status))
+
+    # Available at $MAUBOT_URL/_matrix/maubot/plugin/<instance ID>/jobs/<job ID>
+    @web.get("/jobs/{job_id}")
+    async def get_job(self, request: Request) -> Response:
+        if request.rel_url.query.get("secret") != self.get_secret_from_config():
+            return Response(status=403)
+
+        job = self._jobs.get(request.match_info["job_id"])
+        if job is None:
+            return Response(status=404, text="job not found, or finished too long ago")
+        return json_response(job.serialize())
+
+    # Available at $MAUBOT_URL/_matrix/maubot/plugin/<instance ID>/metrics
+    @web.get("/metrics")
+    async def get_metrics(self, request: Request) -> Response:
+        return self.metrics.response(request, self.get_secret_from_config())
+
+    async def notify(self, request: Request) -> Response:
         # avoid stray requests
         if request.rel_url.query["secret"] != self.get_secret_from_config():
             return Response(status=403)
@@ -51,10 +175,154 @@ class PostToRoom(Plugin):
         if "room" not in data or "message" not in data:
             return Response(status=400, text="room and message both must be provided")
 
-        room_id = await self.get_room_id(data["room"])
-        await self.client.send_markdown(RoomID(room_id), data["message"])
+        # respond right away, the message is sent by a worker
+        if self._async_mode:
+            return self.accept_job(data["room"], data["message"], request.headers.get("Idempotency-Key"))
+
+        try:
+            room_id = await self.get_room_id(data["room"])
+        except MNotFound:
+            return Response(status=404, text="room not found")
+
+        await self.send_markdown(RoomID(room_id), data["message"])
         return Response(status=200)
 
+    # Retries of a request with the same Idempotency-Key header get the job created by the first request
+    def accept_job(self, room: str, message: str, idempotency_key: Optional[str]) -> Response:
+        if idempotency_key:
+            job = self._jobs.get(self._idempotency_keys.get(idempotency_key))
+            if job is not None:
+                return json_response(job.serialize(), status=202)
+
+        job = Job(room, message, idempotency_key)
+        queue = self._job_queues[hash(room) % len(self._job_queues)]
+        if queue.full():
+            return Response(status=503, text="too many jobs queued", headers={"Retry-After": "60"})
+
+        # unfinished jobs are never forgotten, or a retry would post the message again
+        if not self.add_job(job):
+            return Response(status=503, text="too many unfinished jobs", headers={"Retry-After": "60"})
+        queue.put_nowait(job)
+        return json_response(job.serialize(), status=202)
+
+    # Returns False if there are max_jobs already and none of them is finished
+    def add_job(self, job: Job) -> bool:
+        # finished jobs are forgotten after job_retention, and the oldest ones once there are max_jobs
+        expired_before = time.monotonic() - self.config["job_retention"]
+        while self._finished_jobs:
+            oldest = next(iter(self._finished_jobs.values()))
+            if len(self._jobs) < self.config["max_jobs"] and oldest.finished_at > expired_before:
+                break
+            self.forget_job(oldest)
+
+        if len(self._jobs) >= self.config["max_jobs"]:
+            return False
+
+        self._jobs[job.job_id] = job
+        if job.idempotency_key:
+            self._idempotency_keys[job.idempotency_key] = job.job_id
+        return True
+
+    def forget_job(self, job: Job) -> None:
+        del self._jobs[job.job_id]
+        self._finished_jobs.pop(job.job_id, None)
+        if job.idempotency_key and self._idempotency_keys.get(job.idempotency_key) == job.job_id:
+            del self._idempotency_keys[job.idempotency_key]
+
+    async def deliver_jobs(self, queue: asyncio.Queue) -> None:
+        while True:
+            job = await queue.get()
+            job.state = "sending"
+            try:
+                room_id = await self.get_room_id(job.room)
+                job.event_id = await self.send_markdown(RoomID(room_id), job.message)
+                job.state = "sent"
+            except MNotFound:
+                job.state = "failed"
+                job.error = "room not found"
+            except Exception as e:
+                self.log.exception(f"failed to deliver job {job.job_id}")
+                job.state = "failed"
+                job.error = str(e) or type(e).__name__
+            finally:
+                job.finished_at = time.monotonic()
+                self._finished_jobs[job.job_id] = job
+                self.jobs_total.inc(job.state)
+                queue.task_done()
+
+    # Body is a JSON array of {"room": ..., "message": ...} objects, same as for /notify.
+    # Responds with a JSON array holding, for each item in the same order, its status and event_id (or error).
+    async def notify_bulk(self, request: Request) -> Response:
+        # avoid stray requests
+        if request.rel_url.query["secret"] != self.get_secret_from_config():
+            return Response(status=403)
+
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return Response(status=400, text="error decoding json")
+
+        if not isinstance(data, list):
+            return Response(status=400, text="an array of {room, message} objects must be provided")
+        if len(data) > self.config["bulk_max_items"]:
+            return Response(status=413, text=f"at most {self.config['bulk_max_items']} items can be provided")
+
+        results: List[Dict] = [{} for _ in data]
+        items = []
+        for index, item in enumerate(data):
+            if not isinstance(item, dict) or not item.get("room") or not isinstance(item.get("message"), str):
+                results[index] = {"status": 400, "error": "room and message both must be provided"}
+            else:
+                items.append((index, str(item["room"]), item["message"]))
+
+        # each room is resolved, and each message rendered, only once
+        wheres = list({where for _, where, _ in items})
+        room_ids = dict(zip(wheres, await asyncio.gather(*map(self.get_room_id, wheres), return_exceptions=True)))
+        messages = list({message for _, _, message in items})
+        contents = dict(zip(messages, await asyncio.gather(*map(self.render_message, messages))))
+
+        items_by_room = {}  # room_id -> items, in the order they were provided
+        for index, where, message in items:
+            room_id = room_ids[where]
+            if isinstance(room_id, Exception):
+                results[index] = self.get_error_result(room_id)
+            else:
+                items_by_room.setdefault(room_id, []).append((index, message))
+
+        # rooms are sent to concurrently, messages to the same room one after the other
+        semaphore = asyncio.Semaphore(self.config["bulk_concurrency"])
+
+        async def send_to_room(room_id: str, room_items: List) -> None:
+            for index, message in room_items:
+                async with semaphore:
+                    try:
+                        event_id = await self.send_scheduler.send(
+                            room_id, lambda: self.client.send_message(RoomID(room_id), contents[message])
+                        )
+                    except Exception as e:
+                        self.log.exception(f"failed to post to {room_id}")
+                        results[index] = self.get_error_result(e)
+                    else:
+                        results[index] = {"status": 200, "event_id": event_id}
+
+        await asyncio.gather(*(send_to_room(room_id, room_items) for room_id, room_items in items_by_room.items()))
+        return json_response(results)
+
+    async def send_markdown(self, room_id: RoomID, message: str) -> str:
+        return await self.send_scheduler.send(room_id, lambda: self.client.send_markdown(room_id, message))
+
+    @staticmethod
+    async def render_message(markdown: str) -> TextMessageEventContent:
+        content = TextMessageEventContent(msgtype=MessageType.TEXT, format=Format.HTML)
+        content.body, content.formatted_body = await parse_formatted(markdown)
+        return content
+
+    @staticmethod
+    def get_error_result(e: Exception) -> Dict:
+        if isinstance(e, MNotFound):
+            return {"status": 404, "error": "room not found"}
+        return {"status": 502, "error": str(e) or type(e).__name__}
+
     # acceptable value for room "where":
     # room alias part such as "core", "#core"
     # room alias such as "#core:community.wordpress.org"
@@ -70,12 +338,56 @@ class PostToRoom(Plugin):
 
         return await self.resolve_room_alias(room_alias)
 
+    # Aliases are cached for alias_cache_ttl, so that an alias moved to another room is eventually followed.
+    # Aliases that don't exist are cached too, for alias_negative_cache_ttl.
     async def resolve_room_alias(self, room_alias: str) -> str:
-        room_alias_local_part = room_alias[1:].split(':')[0]
+        # Only from a crawl as recent as the cache would be, else an alias moved once nobody crawls any more would
+        # point to its previous room for good
+        crawled_at = self.room_directory.crawled_at
+        if crawled_at is not None and time.monotonic() - crawled_at < self.config["alias_cache_ttl"]:
+            room_id = self.room_directory.get_room_id_by_alias(room_alias)
+            if room_id is not None:
+                self.alias_lookups_total.inc("directory")
+                return room_id
 
-        # fetch & cache, if we don't already have it in cache
-        if room_alias_local_part not in self._cached_resolved_room_aliases:
+        cached = self._cached_resolved_room_aliases.get(room_alias)
+        if cached is not None and cached[0] > time.monotonic():
+            self._cached_resolved_room_aliases.move_to_end(room_alias)
+            room_id = cached[1]
+            self.alias_lookups_total.inc("hit" if room_id else "negative_hit")
+        else:
+            self.alias_lookups_total.inc("miss")
+            lookup = self._room_alias_lookups.get(room_alias)
+            if lookup is None:
+                lookup = self.loop.create_task(self.lookup_room_alias(room_alias))
+                self._room_alias_lookups[room_alias] = lookup
+                lookup.add_done_callback(lambda _: self._room_alias_lookups.pop(room_alias, None))
+
+            room_id = await asyncio.shield(lookup)
+
+        if room_id is None:
+            raise MNotFound(404, f"room alias {room_alias} not found")
+        return room_id
+
+    async def lookup_room_alias(self, room_alias: str) -> Optional[str]:
+        try:
             room_alias_info = await self.client.resolve_room_alias(RoomAlias(room_alias))
-            self._cached_resolved_room_aliases[room_alias_local_part] = room_alias_info.room_id
+        except MNotFound:
+            self.cache_room_alias(room_alias, None, self.config["alias_negative_cache_ttl"])
+            return None
+
+        # other errors aren't cached, the alias will be resolved again with the next request
+        self.cache_room_alias(room_alias, room_alias_info.room_id, self.config["alias_cache_ttl"])
+        return room_alias_info.room_id
+
+    def cache_room_alias(self, room_alias: str, room_id: Optional[str], ttl: float) -> None:
+        self._cached_resolved_room_aliases[room_alias] = (time.monotonic() + ttl, room_id)
+        self._cached_resolved_room_aliases.move_to_end(room_alias)
+        while len(self._cached_resolved_room_aliases) > self.config["alias_cache_size"]:
+            self._cached_resolved_room_aliases.popitem(last=False)
 
-        return self._cached_resolved_room_aliases[room_alias_local_part]
+    # An alias of a room that changed or left the directory may have moved, so it's resolved again next time
+    def handle_directory_changes(self, changes: DirectoryChanges) -> None:
+        for room in (*changes.removed, *(before for before, _ in changes.changed)):
+            for room_alias in room.aliases:
+                self._cached_resolved_room_aliases.pop(room_alias, None)
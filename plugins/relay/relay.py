@@ -1,24 +1,242 @@
+import asyncio
 import json
+import random
+import re
+import time
+from collections import OrderedDict, deque
 
 import aiohttp
 from aiohttp import ClientResponse
+from aiohttp.web import Request, Response
 from maubot import Plugin, MessageEvent
-from maubot.handlers import event
-from mautrix.types import EventType
+from maubot.handlers import event, web
+from maubot.matrix import parse_formatted
+from mautrix.errors import MNotFound
+from mautrix.types import EventType, RoomAlias, RoomID, Format, MessageType, TextMessageEventContent
+from mautrix.util.async_db import UpgradeTable, Connection
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
-from typing import Type
+from typing import Deque, Dict, List, Optional, Set, Tuple, Type
+from wporg_directory import get_shared_room_directory
+from wporg_metrics import Metrics
+from wporg_send import get_send_scheduler
+
+
+OUTBOX_PAGE_SIZE = 1000  # events read from the outbox at a time, when draining it
+ROUTING_RETRY_DELAY = 30  # secs, before aliases of the routing config that failed to be resolved are tried again
 
 
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("webhook")
         helper.copy("secret")
+        helper.copy("workers")
+        helper.copy("queue_size")
+        helper.copy("webhook_timeout")
+        helper.copy("room_directory_ttl")
+        helper.copy("room_info_cache_size")
+        helper.copy("batch_mode")
+        helper.copy("batch_max_size")
+        helper.copy("batch_max_linger")
+        helper.copy("retry_base_delay")
+        helper.copy("retry_max_delay")
+        helper.copy("circuit_breaker_threshold")
+        helper.copy("circuit_breaker_timeout")
+        helper.copy("routing")
+        helper.copy("metrics_secret")
+        helper.copy("send_rate")
+        helper.copy("send_burst")
+        helper.copy("send_concurrency")
+
+
+upgrade_table = UpgradeTable()
+
+
+@upgrade_table.register(description="Outbox of events not yet relayed")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE outbox (
+            event_id    TEXT PRIMARY KEY,
+            room_id     TEXT NOT NULL,
+            thread_root TEXT NOT NULL,
+            timestamp   BIGINT NOT NULL,
+            user_id     TEXT NOT NULL,
+            text        TEXT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Webhook chosen by routing")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute("ALTER TABLE outbox ADD COLUMN webhook TEXT NOT NULL DEFAULT ''")
+
+
+# An event in the outbox, it stays there until the webhook has acknowledged it
+class OutboxEvent:
+    __slots__ = ("event_id", "room_id", "thread_root", "timestamp", "user_id", "text", "webhook", "stored")
+
+    def __init__(self, event_id: str, room_id: str, thread_root: str, timestamp: int, user_id: str, text: str,
+                 webhook: str):
+        self.event_id = event_id
+        self.room_id = room_id
+        self.thread_root = thread_root
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.text = text
+        self.webhook = webhook  # empty for the default webhook
+        self.stored: Optional[asyncio.Task] = None  # pending write to the outbox
+
+    @classmethod
+    def from_event(cls, evt: MessageEvent, webhook: str) -> "OutboxEvent":
+        thread_root = ""
+        if str(evt.content.relates_to.rel_type) == "m.thread":
+            thread_root = evt.content.relates_to.event_id
+
+        return cls(evt.event_id, evt.room_id, thread_root, evt.timestamp, evt.sender, evt.content.body, webhook)
+
+
+# Keywords match case-insensitively anywhere in the message, patterns are regular expressions
+def compile_prefilter(keywords: List[str], patterns: List[str]) -> Optional[re.Pattern]:
+    alternatives = [f"(?:{pattern})" for pattern in patterns]
+    if keywords:
+        alternatives.insert(0, "(?i:" + "|".join(re.escape(keyword) for keyword in keywords) + ")")
+
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives))
+
+
+# Room aliases given in the routing config, which are resolved to room IDs before the config is compiled
+def get_routing_aliases(routing: Optional[dict]) -> Set[str]:
+    routing = routing or {}
+    rooms = [*(routing.get("allow_rooms") or []), *(routing.get("deny_rooms") or [])]
+    for route in routing.get("routes") or []:
+        rooms.extend(route.get("rooms") or [])
+    return {room for room in rooms if room.startswith("#")}
+
+
+# Aliases that couldn't be resolved match no room
+def get_routing_room_ids(rooms: Optional[List[str]], room_ids: Dict[str, str]) -> List[str]:
+    return [room_ids[room] if room.startswith("#") else room for room in rooms or []
+            if not room.startswith("#") or room in room_ids]
+
+
+# Decides which messages are relayed and to which webhook, compiled once whenever config is loaded.
+# Rooms are matched by room ID, those given by alias by the room ID the alias resolved to (room_ids).
+class Router:
+    def __init__(self, routing: Optional[dict], room_ids: Optional[Dict[str, str]] = None):
+        routing = routing or {}
+        room_ids = room_ids or {}
+        self.allow_rooms = None  # any room
+        if routing.get("allow_rooms"):
+            self.allow_rooms = frozenset(get_routing_room_ids(routing["allow_rooms"], room_ids))
+        self.deny_rooms = frozenset(get_routing_room_ids(routing.get("deny_rooms"), room_ids))
+        self.prefilter = compile_prefilter(routing.get("keywords") or [], routing.get("patterns") or [])
+
+        # room id -> (webhook, prefilter)
+        self.routes: Dict[str, Tuple[str, Optional[re.Pattern]]] = {}
+        for route in routing.get("routes") or []:
+            prefilter = self.prefilter
+            if route.get("keywords") or route.get("patterns"):
+                prefilter = compile_prefilter(route.get("keywords") or [], route.get("patterns") or [])
+            for room_id in get_routing_room_ids(route.get("rooms"), room_ids):
+                self.routes.setdefault(room_id, (route.get("webhook") or "", prefilter))
+
+    # returns the webhook to relay the message to ("" for the default one) or None if it shouldn't be relayed
+    def route(self, room_id: str, text: str) -> Optional[str]:
+        if room_id in self.deny_rooms:
+            return None
+
+        if self.allow_rooms is not None and room_id not in self.allow_rooms:
+            return None
+
+        webhook, prefilter = self.routes.get(room_id) or ("", self.prefilter)
+        if prefilter is not None and prefilter.search(text) is None:
+            return None
+
+        return webhook
+
+
+def get_event_ids(batch: List[OutboxEvent]) -> str:
+    return ", ".join(outbox_event.event_id for outbox_event in batch)
+
+
+# 5xx, 429 & network errors are retried, any other error response means the webhook will never accept the event
+class WebhookError(Exception):
+    def __init__(self, status: int, text: str):
+        super().__init__(f"webhook failure: [{status}] {text}")
+        self.retry = status >= 500 or status == 429
+
+
+# Stops all workers from sending requests to a webhook that keeps failing, for `timeout` seconds.
+# Once that's over, each worker lets one request through to probe whether the webhook has recovered.
+class CircuitBreaker:
+    def __init__(self, threshold: int, timeout: float):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold and time.monotonic() < self.opened_at + self.timeout
+
+    async def wait(self) -> None:
+        while self.is_open():
+            await asyncio.sleep(self.opened_at + self.timeout - time.monotonic())
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
 
 
 class Relay(Plugin):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._room_directory_cache = None
+        self.room_directory = None  # shared by all plugins using the same Matrix user
+        self._room_state_cache = OrderedDict()  # room_id -> (expires at, (name, alias)) of unpublished rooms
+        self._room_state_lookups = {}  # room_id -> in-flight lookup task, so a room is only looked up once
+        self._session = None  # shared by all webhook requests, so that connections are reused
+        self._queues: List[asyncio.Queue] = []  # one per worker, a room always maps to the same worker
+        self._workers: List[asyncio.Task] = []
+        self._drain_task = None
+        # Until the events left in the outbox have been queued, new events are only added to the outbox too, so that
+        # events of a room are relayed in order. Same when a queue is full, until the outbox is drained again.
+        self._draining = True
+        self._queued_ids = set()  # event IDs in a queue or being relayed, the outbox drainer skips these
+        # event IDs removed from the outbox while draining, since the drainer's last read started: that read may have
+        # found them still there, the drainer skips these too
+        self._delivered_ids = set()
+        self._deferring = 0  # events being added to the outbox while draining
+        self._deferred_writes = 0  # events added to the outbox while draining, so far
+        self._circuit_breakers: Dict[str, CircuitBreaker] = {}  # webhook -> its circuit breaker
+        self._router = None  # until the aliases in the routing config have been resolved
+        self._routing = None  # routing config the router was last compiled from, or is being compiled from
+        self._routing_room_ids: Dict[str, str] = {}  # alias in the routing config -> room ID it resolved to
+        self._routing_task = None
+        self._unrouted: Deque[MessageEvent] = deque()  # messages received while the router wasn't ready, oldest first
+        self.send_scheduler = None
+        self._filtered = 0
+        self._relayed = 0
+        self._retried = 0
+        self._failed = 0
+        self._deferred = 0
+
+        self.metrics = Metrics()
+        self.webhook_request_seconds = self.metrics.histogram(
+            "relay_webhook_request_seconds", "Round-trip time of webhook requests by outcome", ("mode", "result"))
+        self.metrics.gauge_callback("relay_queued_events", "Number of messages waiting to be relayed",
+                                    self.get_queue_depth)
+        self.metrics.gauge_callback(
+            "relay_circuits_open", "Number of webhooks whose circuit breaker is open",
+            lambda: self.get_queue_stats()["circuits_open"])
+        self.metrics.counter_callback(
+            "relay_events_total", "Messages by outcome",
+            lambda: {(key,): value for key, value in self.get_queue_stats().items()
+                     if key in ("relayed", "retried", "failed", "deferred", "filtered")},
+            ("result",))
 
     def get_command_name(self) -> str:
         return self.id
@@ -27,26 +245,180 @@ class Relay(Plugin):
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
 
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
+
     async def start(self) -> None:
         await super().start()
         self.config.load_and_update()
+        self.send_scheduler = get_send_scheduler(
+            self.client.mxid, self.config["send_rate"], self.config["send_burst"], self.config["send_concurrency"]
+        )
+
+        # fails on start if the routing config is invalid, rooms given by alias are routed once they're resolved
+        router = Router(self.config["routing"])
+        self._routing = self.config["routing"]
+        if not get_routing_aliases(self._routing):
+            self._router = router
+
+        workers = max(1, self.config["workers"])
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=workers),
+            timeout=aiohttp.ClientTimeout(total=self.config["webhook_timeout"]),
+        )
+        self._queues = [asyncio.Queue(maxsize=self.config["queue_size"]) for _ in range(workers)]
+        self._workers = [self.loop.create_task(self.relay_from_queue(queue)) for queue in self._queues]
+
+        # events that were not relayed before the last stop
+        self._drain_task = self.loop.create_task(self.drain_outbox())
+
+        # names and aliases of published rooms, crawled every room_directory_ttl secs (or sooner, for other plugins)
+        self.room_directory = get_shared_room_directory(self.client, self.log)
+        self.room_directory.subscribe(self.id, self.config["room_directory_ttl"])
+
+        self._routing_task = self.loop.create_task(self.refresh_routing())
+
+    async def pre_stop(self) -> None:
+        if self.room_directory is not None:
+            self.room_directory.unsubscribe(self.id)
+        if self._routing_task is not None:
+            self._routing_task.cancel()
+        if self._drain_task is not None and not self._drain_task.done():
+            self._drain_task.cancel()
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+        queued = self.get_queue_depth()
+        if queued:
+            self.log.warning(f"stopping with {queued} events not relayed, they will be relayed after restart")
+        if self._unrouted:
+            self.log.warning(f"stopping with {len(self._unrouted)} events not routed yet, they are lost")
+
+        if self._session is not None:
+            await self._session.close()
+
+    async def on_external_config_update(self) -> None:
+        self.config.load_and_update()
+        try:
+            Router(self.config["routing"])
+        except re.error:
+            self.log.exception("invalid routing config, keeping previous routing")
+            return
+        self._routing = self.config["routing"]
+        await self.update_routing()
+
+    # Aliases in the routing config are resolved again every room_directory_ttl secs, in case they were moved
+    async def refresh_routing(self) -> None:
+        while True:
+            resolved = await self.update_routing()
+            await asyncio.sleep(self.config["room_directory_ttl"] if resolved else ROUTING_RETRY_DELAY)
+
+    # Returns False if some aliases couldn't be resolved, these keep matching the room they resolved to before if any
+    async def update_routing(self) -> bool:
+        routing = self._routing
+        resolved = True
+        room_ids = {}
+        for alias in get_routing_aliases(routing):
+            try:
+                room_ids[alias] = (await self.client.resolve_room_alias(RoomAlias(alias))).room_id
+            except MNotFound:
+                self.log.warning(f"room alias {alias} of the routing config not found")
+            except Exception:
+                self.log.exception(f"failed to resolve room alias {alias} of the routing config, will retry")
+                resolved = False
+                if alias in self._routing_room_ids:
+                    room_ids[alias] = self._routing_room_ids[alias]
+
+        # unless the config was updated meanwhile
+        if routing is self._routing:
+            self._router = Router(routing, room_ids)
+            self._routing_room_ids = room_ids
+            while self._unrouted:
+                await self.route_message(self._unrouted.popleft())
+        return resolved
+
+    # Available at $MAUBOT_URL/_matrix/maubot/plugin/<instance ID>/metrics
+    @web.get("/metrics")
+    async def get_metrics(self, request: Request) -> Response:
+        return self.metrics.response(request, self.config["metrics_secret"])
 
     def get_webhook_from_config(self) -> str:
         return self.config["webhook"]
 
+    def get_circuit_breaker(self, webhook: str) -> CircuitBreaker:
+        circuit_breaker = self._circuit_breakers.get(webhook)
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker(
+                self.config["circuit_breaker_threshold"], self.config["circuit_breaker_timeout"]
+            )
+            self._circuit_breakers[webhook] = circuit_breaker
+        return circuit_breaker
+
     def get_secret_from_config(self) -> str:
         return self.config["secret"]
 
-    async def get_room_name_and_alias_by_id(self, room_id: str) -> (str, str):
-        if self._room_directory_cache is None:
-            directory = await self.client.get_room_directory(limit=1000)
-            self._room_directory_cache = directory.chunk
+    def get_queue(self, room_id: RoomID) -> asyncio.Queue:
+        return self._queues[hash(room_id) % len(self._queues)]
+
+    def get_queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def get_queue_stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.get_queue_depth(),
+            "relayed": self._relayed,
+            "retried": self._retried,
+            "failed": self._failed,
+            "deferred": self._deferred,
+            "filtered": self._filtered,
+            "circuits_open": sum(circuit_breaker.is_open() for circuit_breaker in self._circuit_breakers.values()),
+        }
+
+    # Never waits for the room directory, rooms that aren't (yet) in it are looked up from their state
+    async def get_room_name_and_alias_by_id(self, room_id: RoomID) -> (str, str):
+        room = self.room_directory.get_room(room_id)
+        if room is not None:
+            return room.name, room.alias
 
-        for room_listing in self._room_directory_cache:
-            if room_id == room_listing.room_id:
-                return room_listing.name, room_listing.canonical_alias
+        cached = self._room_state_cache.get(room_id)
+        if cached is not None and cached[0] > time.monotonic():
+            self._room_state_cache.move_to_end(room_id)
+            return cached[1]
 
-        return "", ""
+        lookup = self._room_state_lookups.get(room_id)
+        if lookup is None:
+            lookup = self.loop.create_task(self.get_room_name_and_alias_from_state(room_id))
+            self._room_state_lookups[room_id] = lookup
+            lookup.add_done_callback(lambda _: self._room_state_lookups.pop(room_id, None))
+
+        return await asyncio.shield(lookup)
+
+    async def get_room_name_and_alias_from_state(self, room_id: RoomID) -> (str, str):
+        try:
+            room_name = await self.get_room_state_field(room_id, EventType.ROOM_NAME, "name")
+            room_alias = await self.get_room_state_field(room_id, EventType.ROOM_CANONICAL_ALIAS, "canonical_alias")
+        except Exception:
+            # not cached, so it will be retried with the next message
+            self.log.exception("failed to get name and alias of room %s", room_id)
+            return "", ""
+
+        self._room_state_cache[room_id] = (time.monotonic() + self.config["room_directory_ttl"], (room_name, room_alias))
+        self._room_state_cache.move_to_end(room_id)
+        while len(self._room_state_cache) > self.config["room_info_cache_size"]:
+            self._room_state_cache.popitem(last=False)
+
+        return room_name, room_alias
+
+    async def get_room_state_field(self, room_id: RoomID, event_type: EventType, field: str) -> str:
+        try:
+            content = await self.client.get_state_event(room_id, event_type)
+        except MNotFound:
+            return ""
+        return getattr(content, field, None) or ""
 
     @event.on(EventType.ROOM_MESSAGE)
     async def handle_message(self, evt: MessageEvent) -> None:
@@ -59,42 +431,242 @@ class Relay(Plugin):
         if evt.content.body.startswith("!") or evt.content.body.startswith("/"):
             return
 
-        # Send message content as HTTP request
-        async with aiohttp.ClientSession() as session:
-            # prepare payload for webhook request
-            room_name, room_alias = await self.get_room_name_and_alias_by_id(evt.room_id)
-            thread_root = ""
-            if str(evt.content.relates_to.rel_type) == "m.thread":
-                thread_root = evt.content.relates_to.event_id
-
-            # Note: room_name and room_alias can be empty if room isn't published in room directory
-            payload = aiohttp.FormData({
-                "secret": self.get_secret_from_config(),
-                "room_id": evt.room_id,
-                "room_name": room_name,
-                "room_alias": room_alias,
-                "event_id": evt.event_id,
-                "thread_root": thread_root,
-                "timestamp": evt.timestamp,
-                "user_id": evt.sender,
-                "text": evt.content.body,
-            })
-
-            self.log.debug("sending request to %s for evt: %s", self.get_webhook_from_config(), evt.event_id)
-
-            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-            async with session.post(self.get_webhook_from_config(), headers=headers, data=payload) as response:
-                await self.respond(evt, response)
+        # those received before are routed first, so that messages of a room keep their order
+        if self._router is None or self._unrouted:
+            self._unrouted.append(evt)
+            return
+
+        await self.route_message(evt)
+
+    async def route_message(self, evt: MessageEvent) -> None:
+        # Cheap in-process check, before any HTTP work
+        webhook = self._router.route(evt.room_id, evt.content.body)
+        if webhook is None:
+            self._filtered += 1
+            return
+
+        # Webhook requests are made by workers, so that a slow webhook doesn't hold up event handling
+        outbox_event = OutboxEvent.from_event(evt, webhook)
+        queue = self.get_queue(evt.room_id)
+        if self._draining or queue.full():
+            self._deferred += 1
+            if not self._draining:
+                self.log.warning("queue full, deferring events to the outbox (%d queued, %d deferred so far)",
+                                 self.get_queue_depth(), self._deferred)
+                self._draining = True
+                self._drain_task = self.loop.create_task(self.drain_outbox())
+
+            # keep it in the outbox only, it's queued by drain_outbox() once the events before it have been
+            self._deferring += 1
+            try:
+                await self.add_to_outbox(outbox_event)
+            finally:
+                self._deferring -= 1
+                self._deferred_writes += 1
+            return
+
+        # queued right away to keep the order of events in the room, the worker waits for the write to the outbox
+        outbox_event.stored = self.loop.create_task(self.add_to_outbox(outbox_event))
+        self._queued_ids.add(outbox_event.event_id)
+        queue.put_nowait(outbox_event)
+
+    async def add_to_outbox(self, outbox_event: OutboxEvent) -> None:
+        await self.database.execute(
+            "INSERT INTO outbox (event_id, room_id, thread_root, timestamp, user_id, text, webhook) "
+            "VALUES ($1, $2, $3, $4, $5, $6, $7) ON CONFLICT (event_id) DO NOTHING",
+            outbox_event.event_id, outbox_event.room_id, outbox_event.thread_root,
+            outbox_event.timestamp, outbox_event.user_id, outbox_event.text, outbox_event.webhook,
+        )
+
+    async def remove_from_outbox(self, batch: List[OutboxEvent]) -> None:
+        await self.database.executemany(
+            "DELETE FROM outbox WHERE event_id=$1", [(outbox_event.event_id,) for outbox_event in batch]
+        )
+
+    # Queues the events in the outbox, oldest first, waiting for room in the queues. Once there's none left that isn't
+    # queued already, and none being added, new events are queued directly again.
+    async def drain_outbox(self) -> None:
+        while True:
+            deferred_writes = self._deferred_writes
+            self._delivered_ids.clear()
+            try:
+                rows = await self.database.fetch(
+                    "SELECT event_id, room_id, thread_root, timestamp, user_id, text, webhook FROM outbox "
+                    "ORDER BY timestamp LIMIT $1", OUTBOX_PAGE_SIZE + len(self._queued_ids)
+                )
+            except Exception:
+                self.log.exception("failed to read outbox, will retry")
+                await asyncio.sleep(self.config["retry_base_delay"])
+                continue
+
+            rows = [row for row in rows
+                    if row["event_id"] not in self._queued_ids and row["event_id"] not in self._delivered_ids]
+            if not rows:
+                if self._deferring == 0 and deferred_writes == self._deferred_writes:
+                    self._draining = False
+                    self._delivered_ids.clear()
+                    return
+                # an event is being added to the outbox, it may not have been there yet
+                await asyncio.sleep(0.01)
+                continue
+
+            self.log.debug(f"relaying {len(rows)} events from outbox")
+            for row in rows:
+                outbox_event = OutboxEvent(row["event_id"], row["room_id"], row["thread_root"], row["timestamp"],
+                                           row["user_id"], row["text"], row["webhook"])
+                self._queued_ids.add(outbox_event.event_id)
+                await self.get_queue(outbox_event.room_id).put(outbox_event)
+
+    async def relay_from_queue(self, queue: asyncio.Queue) -> None:
+        next_event = None  # taken from the queue while filling a batch, but for a different webhook
+        while True:
+            batch = [next_event or await queue.get()]
+            next_event = None
+            batched = self.config["batch_mode"]
+            if batched:
+                next_event = await self.fill_batch(queue, batch)
+
+            removed = False
+            try:
+                removed = await self.deliver(batch, batched)
+            except Exception:
+                self._failed += len(batch)
+                self.log.exception("failed to relay events %s", get_event_ids(batch))
+            finally:
+                # events left in the outbox are relayed after restart, the outbox drainer must not pick them up again
+                if removed:
+                    event_ids = [outbox_event.event_id for outbox_event in batch]
+                    self._queued_ids.difference_update(event_ids)
+                    if self._draining:
+                        self._delivered_ids.update(event_ids)
+                for _ in batch:
+                    queue.task_done()
+
+    # Waits up to batch_max_linger for more events to fill the batch.
+    # All events in a batch go to the same webhook, the first event for another webhook ends the batch and is returned.
+    async def fill_batch(self, queue: asyncio.Queue, batch: List[OutboxEvent]) -> Optional[OutboxEvent]:
+        deadline = self.loop.time() + self.config["batch_max_linger"]
+
+        while len(batch) < self.config["batch_max_size"]:
+            if not queue.empty():
+                outbox_event = queue.get_nowait()
+            else:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    return None
+
+                try:
+                    outbox_event = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    return None
+
+            if outbox_event.webhook != batch[0].webhook:
+                return outbox_event
+            batch.append(outbox_event)
+
+        return None
+
+    # Delivery is at-least-once: events are retried until the webhook acknowledges them,
+    # `event_id` lets the webhook recognize events it has already received.
+    # Retrying blocks the worker, so that events of a room are never relayed out of order.
+    # Returns whether the events were removed from the outbox
+    async def deliver(self, batch: List[OutboxEvent], batched: bool) -> bool:
+        for outbox_event in batch:
+            if outbox_event.stored is not None:
+                try:
+                    await outbox_event.stored
+                except Exception:
+                    self.log.exception("failed to add event %s to outbox, relaying anyway", outbox_event.event_id)
+
+        webhook = batch[0].webhook or self.get_webhook_from_config()
+        circuit_breaker = self.get_circuit_breaker(webhook)
+
+        attempt = 0
+        while True:
+            await circuit_breaker.wait()
+            mode = "batch" if batched else "single"
+            started = time.perf_counter()
+            try:
+                if batched:
+                    await self.relay_batch(webhook, batch)
+                else:
+                    await self.relay(webhook, batch[0])
+            except (WebhookError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.webhook_request_seconds.observe(time.perf_counter() - started, mode, "error")
+                if isinstance(e, WebhookError) and not e.retry:
+                    circuit_breaker.record_success()
+                    self._failed += len(batch)
+                    self.log.warning("%s for events %s, not retrying", e, get_event_ids(batch))
+                    break
+
+                circuit_breaker.record_failure()
+                self._retried += len(batch)
+                delay = min(self.config["retry_base_delay"] * 2 ** attempt, self.config["retry_max_delay"])
+                delay = random.uniform(delay / 2, delay)
+                attempt += 1
+                self.log.warning("failed to relay events %s (attempt %d), retrying in %.1fs: %s",
+                                 get_event_ids(batch), attempt, delay, e or type(e).__name__)
+                await asyncio.sleep(delay)
+            else:
+                self.webhook_request_seconds.observe(time.perf_counter() - started, mode, "ok")
+                circuit_breaker.record_success()
+                self._relayed += len(batch)
+                break
+
+        try:
+            await self.remove_from_outbox(batch)
+        except Exception:
+            self.log.exception("failed to remove events from outbox, they will be relayed again after restart")
+            return False
+        return True
+
+    async def get_payload(self, outbox_event: OutboxEvent) -> Dict[str, str]:
+        room_name, room_alias = await self.get_room_name_and_alias_by_id(outbox_event.room_id)
+
+        # Note: room_name and room_alias can be empty if room isn't published in room directory
+        return {
+            "secret": self.get_secret_from_config(),
+            "room_id": outbox_event.room_id,
+            "room_name": room_name,
+            "room_alias": room_alias,
+            "event_id": outbox_event.event_id,
+            "thread_root": outbox_event.thread_root,
+            "timestamp": outbox_event.timestamp,
+            "user_id": outbox_event.user_id,
+            "text": outbox_event.text,
+        }
+
+    async def relay(self, webhook: str, outbox_event: OutboxEvent) -> None:
+        # prepare payload for webhook request
+        payload = aiohttp.FormData(await self.get_payload(outbox_event))
+
+        self.log.debug("sending request to %s for evt: %s", webhook, outbox_event.event_id)
+
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Idempotency-Key': outbox_event.event_id,
+        }
+        async with self._session.post(webhook, headers=headers, data=payload) as response:
+            await self.respond([outbox_event], response, batched=False)
+
+    # Sends a JSON array of payloads, the same fields as a single event
+    async def relay_batch(self, webhook: str, batch: List[OutboxEvent]) -> None:
+        payload = [await self.get_payload(outbox_event) for outbox_event in batch]
+
+        self.log.debug("sending request to %s for %d events", webhook, len(batch))
+
+        async with self._session.post(webhook, json=payload) as response:
+            await self.respond(batch, response, batched=True)
 
     # Expected reply fields in JSON response:
     # `messages` or `message` that should be posted to room
     # `reply_in_thread` as true or false - whether reply should be posted directly in room or in thread
     # Note: if event was already in thread, it would always be posted in the thread
-    async def respond(self, evt: MessageEvent, response: ClientResponse):
+    # In batch mode, the JSON response is an object of such replies keyed by `event_id`,
+    # events without a reply can be left out.
+    async def respond(self, batch: List[OutboxEvent], response: ClientResponse, batched: bool):
         if response.status != 200 and response.status != 204:
-            self.log.debug(f"webhook failure: [%s] %s for event: %s",
-                           response.status, await response.text(), evt.event_id)
-            return
+            raise WebhookError(response.status, await response.text())
 
         content_type = response.headers.get('Content-Type', '').lower()
         if "application/json" not in content_type:
@@ -104,18 +676,38 @@ class Relay(Plugin):
             content = await response.json()
         except json.JSONDecodeError:
             self.log.debug(f"failed to decode json response `%s` for event: %s",
-                           response.content, evt.event_id)
+                           response.content, get_event_ids(batch))
             return
 
-        reply_in_thread = content.get("reply_in_thread", False)
-        if str(evt.content.relates_to.rel_type) == "m.thread":
+        if not isinstance(content, dict):
+            return
+
+        for outbox_event in batch:
+            reply = content.get(outbox_event.event_id) if batched else content
+            if not isinstance(reply, dict):
+                continue
+
+            # the webhook has already accepted the event, so failing to reply must not cause a retry
+            try:
+                await self.send_reply(outbox_event, reply)
+            except Exception:
+                self.log.exception("failed to reply to event %s", outbox_event.event_id)
+
+    async def send_reply(self, outbox_event: OutboxEvent, reply: dict):
+        reply_in_thread = reply.get("reply_in_thread", False)
+        if outbox_event.thread_root:
             reply_in_thread = True
 
-        messages = content.get("messages", [])
-        if messages:
-            for message in messages:
-                await evt.respond(content=message, markdown=True, in_thread=reply_in_thread)
-            return
+        messages = reply.get("messages", [])
+        if not messages and "message" in reply:
+            messages = [reply["message"]]
 
-        if "message" in content:
-            await evt.respond(content=content["message"], markdown=True, in_thread=reply_in_thread)
+        for message in messages:
+            content = TextMessageEventContent(msgtype=MessageType.NOTICE, format=Format.HTML)
+            content.body, content.formatted_body = await parse_formatted(message, render_markdown=True)
+            if reply_in_thread:
+                content.set_thread_parent(outbox_event.thread_root or outbox_event.event_id,
+                                          last_event_in_thread=outbox_event.event_id)
+            await self.send_scheduler.send(outbox_event.room_id, lambda: self.client.send_message_event(
+                outbox_event.room_id, EventType.ROOM_MESSAGE, content
+            ))
@@ -1,22 +1,154 @@
+from aiohttp.web import Request, Response
 from maubot import Plugin
-from mautrix.types import RoomID, DirectoryPaginationToken
-from mautrix.types.misc import PublicRoomInfo
+from maubot.handlers import event, web
+from mautrix.errors import MNotFound
+from mautrix.types import EventType, RoomID, RoomDirectoryVisibility, StateEvent
+from mautrix.util.async_db import UpgradeTable, Connection
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
-from typing import Type, List, Dict
+from typing import Type, List, Dict, Optional, Tuple
 import asyncio
+import time
+from html import escape
+from collections import OrderedDict
+from wporg_directory import DirectoryChanges, DirectoryRoom, get_fingerprint, get_shared_room_directory
+from wporg_metrics import Metrics
+from wporg_send import PRIORITY_LOW, get_send_scheduler
 
 
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("room")
         helper.copy("monitoring_interval")
+        helper.copy("adaptive_polling")
+        helper.copy("min_monitoring_interval")
+        helper.copy("max_monitoring_interval")
+        helper.copy("monitoring_interval_backoff")
+        helper.copy("room_details_cache_size")
+        helper.copy("digest_mode")
+        helper.copy("digest_max_size")
+        helper.copy("event_driven")
+        helper.copy("reconciliation_interval")
+        helper.copy("unpublished_rooms_cache_size")
+        helper.copy("unpublished_rooms_cache_ttl")
+        helper.copy("metrics_secret")
+        helper.copy("send_rate")
+        helper.copy("send_burst")
+        helper.copy("send_concurrency")
+
+
+upgrade_table = UpgradeTable()
+
+
+@upgrade_table.register(description="Last known state of the room directory")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE snapshot (
+            room_id TEXT PRIMARY KEY,
+            name    TEXT NOT NULL,
+            topic   TEXT NOT NULL,
+            alias   TEXT NOT NULL
+        )"""
+    )
+
+
+# The fields of a room in the directory that are monitored
+class RoomInfo:
+    __slots__ = ("room_id", "name", "topic", "alias", "fingerprint")
+
+    def __init__(self, room_id: RoomID, name: str, topic: str, alias: str):
+        self.room_id = room_id
+        self.name = name
+        self.topic = topic
+        self.alias = alias
+        self.fingerprint = get_fingerprint(name, topic, alias)
+
+    @classmethod
+    def from_directory_room(cls, room: DirectoryRoom) -> "RoomInfo":
+        return cls(room.room_id, room.name, room.topic, room.alias)
+
+
+# Result of a crawl: fingerprint of every room in the directory, full details only for rooms that are new or changed.
+# Known rooms are fingerprinted the same way when the snapshot is loaded.
+class Crawl:
+    __slots__ = ("fingerprints", "changed_rooms", "pages", "crawled_at")
+
+    def __init__(self):
+        self.fingerprints: Dict[RoomID, int] = {}
+        self.changed_rooms: List[RoomInfo] = []
+        self.pages = 0
+        self.crawled_at = 0.0  # monotonic time the crawl started
+
+
+def shorten(value: str, max_length: int = 300) -> str:
+    return value if len(value) <= max_length else value[:max_length - 1] + "…"
+
+
+# Splits a digest into messages, so that each stays well under the max size of a Matrix event.
+# A section (e.g. "Rooms added") that doesn't fit in one message is continued in the next one.
+class DigestChunker:
+    def __init__(self, summary: str, max_size: int):
+        self.max_size = max_size
+        self.messages: List[Tuple[str, str]] = []
+        self.text = f"**{summary}**\n"
+        self.html = f"<strong>{escape(summary)}</strong><br>"
+        self.title = None  # section open in the current message
+
+    def add(self, title: str, entry_text: str, entry_html: str) -> None:
+        text = html = ""
+        if title != self.title:
+            text = f"**{title}**\n"
+            html = f"{'</ul>' if self.title else ''}<strong>{title}</strong><ul>"
+        text += f"{entry_text}\n"
+        html += f"<li>{entry_html}</li>"
+
+        size = len((self.text + text).encode()) + len((self.html + html + "</ul>").encode())
+        if size > self.max_size and self.title is not None:
+            self.flush()
+            self.add(title, entry_text, entry_html)
+            return
+
+        self.text += text
+        self.html += html
+        self.title = title
+
+    def flush(self) -> None:
+        if self.text:
+            self.messages.append((self.text, self.html + ("</ul>" if self.title else "")))
+        self.text = self.html = ""
+        self.title = None
+
+    def get_messages(self) -> List[Tuple[str, str]]:
+        self.flush()
+        return self.messages
 
 
 class WatchDog(Plugin):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.monitor_rooms_task = None  # hold task object
-        self._cache_room_details = {}
+        self.send_scheduler = None
+        self.room_directory = None  # shared by all plugins using the same Matrix user
+        self._known_rooms: Optional[Dict[RoomID, int]] = None  # room_id -> fingerprint, None until there's a snapshot
+        self._snapshot_lock = asyncio.Lock()  # changes found by crawls and by state events are applied one at a time
+        self._started_at = 0  # ms, older state events are left to the crawl
+        self._monitoring_interval = 0  # secs between the start of two crawls
+        self._last_crawl_pages = 0
+        self._cache_room_details = OrderedDict()  # room_id -> RoomInfo of recently changed or removed rooms
+        self._changed_directory_rooms: Dict[RoomID, DirectoryRoom] = {}  # found by crawls since the last cycle
+        self._state_applied_at: Dict[RoomID, float] = {}  # monotonic time of the last change applied from state events
+        self._last_state_applied_at = 0.0
+        self._unpublished_rooms = OrderedDict()  # room_id -> monotonic time until which it's not checked again
+
+        self.metrics = Metrics()
+        self.messages_total = self.metrics.counter("watchdog_messages_total", "Messages posted to the alerts room")
+        self.metrics.gauge_callback("watchdog_cached_rooms", "Number of rooms whose details are cached",
+                                    lambda: len(self._cache_room_details))
+        self.crawl_seconds = self.metrics.histogram(
+            "watchdog_crawl_seconds", "Time taken to crawl the whole room directory by outcome", ("result",))
+        self.metrics.gauge_callback("watchdog_crawl_pages", "Number of pages fetched by the last crawl",
+                                    lambda: self._last_crawl_pages)
+        self.metrics.gauge_callback("watchdog_monitoring_interval_seconds", "Current time between two crawls",
+                                    lambda: self._monitoring_interval)
 
     def get_command_name(self) -> str:
         return self.id
@@ -25,9 +157,20 @@ class WatchDog(Plugin):
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
 
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
+
     async def start(self) -> None:
         await super().start()
         self.config.load_and_update()
+        self._started_at = int(time.time() * 1000)
+        self.send_scheduler = get_send_scheduler(
+            self.client.mxid, self.config["send_rate"], self.config["send_burst"], self.config["send_concurrency"]
+        )
+        self.room_directory = get_shared_room_directory(self.client, self.log)
+        self.room_directory.subscribe(self.id, callback=self.handle_directory_changes)
+        self.metrics.add(self.room_directory.page_seconds)
 
         await self.post_notice("🔔 watchdog now running")
 
@@ -35,127 +178,387 @@ class WatchDog(Plugin):
         self.monitor_rooms_task = self.loop.create_task(self.monitor_rooms())
 
     async def pre_stop(self) -> None:
+        if self.room_directory is not None:
+            self.room_directory.unsubscribe(self.id)
         if self.monitor_rooms_task is not None and not self.monitor_rooms_task.done():
             self.monitor_rooms_task.cancel()
         await self.post_notice("🔔 watchdog shutting down")
 
+    # Available at $MAUBOT_URL/_matrix/maubot/plugin/<instance ID>/metrics
+    @web.get("/metrics")
+    async def get_metrics(self, request: Request) -> Response:
+        return self.metrics.response(request, self.config["metrics_secret"])
+
     def get_room_from_config(self) -> RoomID:
         return RoomID(self.config["room"])
 
     def get_monitoring_interval_from_config(self) -> int:
+        # with event_driven, the crawl only catches what state events can't tell (e.g. rooms removed from the directory)
+        if self.config["event_driven"]:
+            return self.config["reconciliation_interval"]
         return self.config["monitoring_interval"]
 
+    # With adaptive_polling, the interval is back to its minimum after a crawl that found changes, and grows while
+    # nothing changes. Crawling never takes more than half of the time, however slow the homeserver is.
+    def get_next_monitoring_interval(self, changed: bool, crawl_duration: float) -> float:
+        if self.config["event_driven"] or not self.config["adaptive_polling"]:
+            return self.get_monitoring_interval_from_config()
+
+        if changed:
+            interval = self.config["min_monitoring_interval"]
+        else:
+            interval = self._monitoring_interval * self.config["monitoring_interval_backoff"]
+        interval = max(interval, crawl_duration * 2)
+        return min(max(interval, self.config["min_monitoring_interval"]), self.config["max_monitoring_interval"])
+
     async def monitor_rooms(self) -> None:
-        # can't do anything without having an initial list,
-        # so high max_retries effectively not really needing to catch exception
-        known_rooms = await self.query_room_dir(max_retries=999)
-        known_rooms_ids = known_rooms.keys()
+        self._monitoring_interval = self.get_monitoring_interval_from_config()
+        snapshot_loaded = False
 
         while True:
+            started = time.perf_counter()
+            changed = False
             try:
-                current_rooms = await self.query_room_dir(max_retries=5)
-                current_rooms_ids = current_rooms.keys()
-
-                # figure out rooms added/removed
-                rooms_removed = list(set(known_rooms_ids) - set(current_rooms_ids))
-                rooms_added = list(set(current_rooms_ids) - set(known_rooms_ids))
-
-                await self.handle_room_changes(rooms_removed, "➖ Rooms removed:")
-                await self.handle_room_changes(rooms_added, "➕ Rooms added:")
+                if not snapshot_loaded:
+                    # rooms as of the last cycle before the previous stop, so that changes made while stopped are
+                    # reported too. Nothing is crawled until it's loaded, or they would be taken as a first run.
+                    self._known_rooms = await self.load_snapshot()
+                    snapshot_loaded = True
+                changed = await self.check_rooms()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if snapshot_loaded:
+                    self.crawl_seconds.observe(time.perf_counter() - started, "error")
+                    self.log.exception("failed to fetch room dir while monitoring")
+                else:
+                    self.log.exception("failed to load snapshot, will retry")
+
+            # the interval is counted from the start of the crawl, so that slow crawls don't make cycles drift
+            elapsed = time.perf_counter() - started
+            self._monitoring_interval = self.get_next_monitoring_interval(changed, elapsed)
+            await asyncio.sleep(max(0.0, self._monitoring_interval - elapsed))
+
+    # One monitoring cycle: crawls the directory and reports what changed since the previous one, if anything
+    async def check_rooms(self, max_retries: int = 5) -> bool:
+        started = time.perf_counter()
+        crawl = await self.query_room_dir(max_retries=max_retries, known_rooms=self._known_rooms or {})
+        crawl_duration = time.perf_counter() - started
+        self.crawl_seconds.observe(crawl_duration, "ok")
+        self._last_crawl_pages = crawl.pages
+        self.log.debug(f"crawled {crawl.pages} pages of the room directory in {crawl_duration:.1f}s")
+
+        async with self._snapshot_lock:
+            report = self._known_rooms is not None
+            if not report:
+                # first run, nothing to compare with yet
+                self.log.info(f"saving initial snapshot of {len(crawl.fingerprints)} rooms")
+                self._known_rooms = {}
+
+            # rooms changed by state events since the crawl started are left to the next one, which will know better
+            skipped = {room_id for room_id, applied_at in self._state_applied_at.items()
+                       if applied_at >= crawl.crawled_at}
+            self._state_applied_at = {room_id: self._state_applied_at[room_id] for room_id in skipped}
+
+            rooms_removed = [room_id for room_id in self._known_rooms
+                             if room_id not in crawl.fingerprints and room_id not in skipped]
+            changed_rooms = [room for room in crawl.changed_rooms if room.room_id not in skipped]
+            await self.apply_changes(rooms_removed, changed_rooms, report)
+            return report and bool(rooms_removed or changed_rooms)
+
+    # Reports rooms removed from or added/changed in the directory, then makes them the known state
+    async def apply_changes(self, rooms_removed: List[RoomID], changed_rooms: List[RoomInfo], report: bool = True):
+        if report:
+            # rooms not in the detail cache are looked up in the snapshot, before it's updated
+            removed = [await self.get_room_details(room_id) for room_id in rooms_removed]
+            added = [room for room in changed_rooms if room.room_id not in self._known_rooms]
+            changed = [
+                (await self.get_room_details(room.room_id), room) for room in changed_rooms
+                if room.room_id in self._known_rooms
+            ]
+
+            if self.config["digest_mode"]:
+                await self.post_digest(removed, added, changed)
+            else:
+                await self.handle_room_changes(removed, "➖ Rooms removed:")
+                await self.handle_room_changes(added, "➕ Rooms added:")
 
                 # figure out changes in rooms' name or topic
-                await self.handle_room_meta_changes(known_rooms, current_rooms)
-
-                # update new state as known state
-                known_rooms = current_rooms
-                known_rooms_ids = current_rooms_ids
-
-            except Exception as e:
-                self.log.exception("failed to fetch room dir while monitoring")
-
-            await asyncio.sleep(self.get_monitoring_interval_from_config())
+                await self.handle_room_meta_changes(changed)
+
+            for room in changed_rooms:
+                self.cache_room_details(room)
+
+        await self.save_snapshot(rooms_removed, changed_rooms)
+
+        # update new state as known state
+        for room_id in rooms_removed:
+            self._known_rooms.pop(room_id, None)
+        for room in changed_rooms:
+            self._known_rooms[room.room_id] = room.fingerprint
+
+    @event.on(EventType.ROOM_NAME)
+    @event.on(EventType.ROOM_TOPIC)
+    @event.on(EventType.ROOM_CANONICAL_ALIAS)
+    async def handle_state_event(self, evt: StateEvent) -> None:
+        if not self.config["event_driven"] or evt.timestamp < self._started_at:
+            return
+
+        try:
+            async with self._snapshot_lock:
+                if self._known_rooms is None:
+                    return
+
+                if evt.room_id in self._known_rooms:
+                    room = await self.get_room_details(evt.room_id)
+                    room = RoomInfo(
+                        room.room_id,
+                        (evt.content.name or "") if evt.type == EventType.ROOM_NAME else room.name,
+                        (evt.content.topic or "") if evt.type == EventType.ROOM_TOPIC else room.topic,
+                        (evt.content.canonical_alias or "") if evt.type == EventType.ROOM_CANONICAL_ALIAS else room.alias,
+                    )
+                    if room.fingerprint != self._known_rooms[room.room_id]:
+                        self.set_state_applied(room.room_id)
+                        await self.apply_changes([], [room])
+                    return
+
+            # the room may have been published in the directory since the last crawl, checked without holding up
+            # crawls and other events meanwhile
+            room = await self.get_published_room_from_state(evt.room_id)
+            if room is None:
+                return
+
+            async with self._snapshot_lock:
+                # unless a crawl found it as it is meanwhile
+                if room.fingerprint != self._known_rooms.get(room.room_id):
+                    self.set_state_applied(room.room_id)
+                    await self.apply_changes([], [room])
+        except Exception:
+            self.log.exception(f"failed to handle {evt.type} in {evt.room_id}, leaving it to the next crawl")
+
+    # Crawls started before this don't know about the change, so they must not revert it
+    def set_state_applied(self, room_id: RoomID) -> None:
+        self._last_state_applied_at = self._state_applied_at[room_id] = time.monotonic()
+
+    # Returns None if the room isn't published in the room directory. Such rooms aren't checked again for
+    # unpublished_rooms_cache_ttl secs, so that busy rooms don't have the homeserver asked with each of their changes.
+    async def get_published_room_from_state(self, room_id: RoomID) -> Optional[RoomInfo]:
+        checked_until = self._unpublished_rooms.get(room_id)
+        if checked_until is not None and checked_until > time.monotonic():
+            return None
+
+        visibility = await self.client.get_room_directory_visibility(room_id)
+        if visibility != RoomDirectoryVisibility.PUBLIC:
+            self._unpublished_rooms[room_id] = time.monotonic() + self.config["unpublished_rooms_cache_ttl"]
+            self._unpublished_rooms.move_to_end(room_id)
+            while len(self._unpublished_rooms) > self.config["unpublished_rooms_cache_size"]:
+                self._unpublished_rooms.popitem(last=False)
+            return None
+
+        self._unpublished_rooms.pop(room_id, None)
+        return await self.get_room_info_from_state(room_id)
+
+    async def get_room_info_from_state(self, room_id: RoomID) -> RoomInfo:
+        name = await self.get_room_state_field(room_id, EventType.ROOM_NAME, "name")
+        topic = await self.get_room_state_field(room_id, EventType.ROOM_TOPIC, "topic")
+        alias = await self.get_room_state_field(room_id, EventType.ROOM_CANONICAL_ALIAS, "canonical_alias")
+        return RoomInfo(room_id, name, topic, alias)
+
+    async def get_room_state_field(self, room_id: RoomID, event_type: EventType, field: str) -> str:
+        try:
+            content = await self.client.get_state_event(room_id, event_type)
+        except MNotFound:
+            return ""
+        return getattr(content, field, None) or ""
+
+    def cache_room_details(self, room: RoomInfo) -> None:
+        self._cache_room_details[room.room_id] = room
+        self._cache_room_details.move_to_end(room.room_id)
+        while len(self._cache_room_details) > self.config["room_details_cache_size"]:
+            self._cache_room_details.popitem(last=False)
+
+    async def get_room_details(self, room_id: RoomID) -> RoomInfo:
+        room = self._cache_room_details.get(room_id)
+        if room is not None:
+            return room
+
+        row = await self.database.fetchrow("SELECT name, topic, alias FROM snapshot WHERE room_id=$1", room_id)
+        if row is None:
+            return RoomInfo(room_id, "", "", "")
+        room = RoomInfo(room_id, row["name"], row["topic"], row["alias"])
+        self.cache_room_details(room)
+        return room
+
+    # only fingerprints are kept in memory, details of known rooms stay in the database
+    async def load_snapshot(self) -> Optional[Dict[RoomID, int]]:
+        rows = await self.database.fetch("SELECT room_id, name, topic, alias FROM snapshot")
+        if not rows:
+            return None
+
+        return {RoomID(row["room_id"]): get_fingerprint(row["name"], row["topic"], row["alias"]) for row in rows}
+
+    # only rooms that were added, removed or changed since the last cycle are written
+    async def save_snapshot(self, removed: List[RoomID], changed: List[RoomInfo]) -> None:
+        if not removed and not changed:
+            return
+
+        async with self.database.acquire() as conn, conn.transaction():
+            if removed:
+                await conn.executemany("DELETE FROM snapshot WHERE room_id=$1", [(room_id,) for room_id in removed])
+            if changed:
+                await conn.executemany(
+                    "INSERT INTO snapshot (room_id, name, topic, alias) VALUES ($1, $2, $3, $4) "
+                    "ON CONFLICT (room_id) DO UPDATE SET name=excluded.name, topic=excluded.topic, alias=excluded.alias",
+                    [(room.room_id, room.name, room.topic, room.alias) for room in changed]
+                )
 
-    async def handle_room_changes(self, room_list: List[RoomID], message_prefix: str) -> None:
+    async def handle_room_changes(self, room_list: List[RoomInfo], message_prefix: str) -> None:
         if room_list:
             text_message = f"**{message_prefix}**\n"
             html_message = f"<strong>{message_prefix}</strong><br><ul>"
-            for room_id in room_list:
-                text_message += f"{self._cache_room_details[room_id].name} `{room_id}`\n"
-                html_message += f"<li>{self._cache_room_details[room_id].name} <code>{room_id}</code></li>"
+            for room in room_list:
+                text_message += f"{room.name} `{room.room_id}`\n"
+                html_message += f"<li>{room.name} <code>{room.room_id}</code></li>"
             html_message += f"</ul>"
             await self.post_message(text_message, html_message)
 
-    async def handle_room_meta_changes(self, known_rooms: Dict[RoomID, PublicRoomInfo],
-                                       current_rooms: Dict[RoomID, PublicRoomInfo]):
-        for room_id in current_rooms:
-            if room_id in known_rooms and current_rooms[room_id].name != known_rooms[room_id].name:
+    async def handle_room_meta_changes(self, changes: List[Tuple[RoomInfo, RoomInfo]]):
+        for known_room, current_room in changes:
+            room_id = current_room.room_id
+            if current_room.name != known_room.name:
                 text_message = (
-                    f"**Room name update:**\n`{known_rooms[room_id].name}` -> `{current_rooms[room_id].name}`"
+                    f"**Room name update:**\n`{known_room.name}` -> `{current_room.name}`"
                     f"`{room_id}`")
                 html_message = (
-                    f"<strong>Room name update:</strong><br><code>{known_rooms[room_id].name}</code> -> "
-                    f"<code>{current_rooms[room_id].name}</code><br><code>{room_id}</code>"
+                    f"<strong>Room name update:</strong><br><code>{known_room.name}</code> -> "
+                    f"<code>{current_room.name}</code><br><code>{room_id}</code>"
                 )
                 await self.post_message(text_message, html_message)
 
-                if room_id in known_rooms and current_rooms[room_id].topic != known_rooms[room_id].topic:
-                    text_message = (
-                        f"**Room topic update:**\n`{current_rooms[room_id].name}`\n`{known_rooms[room_id].topic}` ->"
-                        f" `{current_rooms[room_id].topic}` `{room_id}`"
-                    )
+            if current_room.topic != known_room.topic:
+                text_message = (
+                    f"**Room topic update:**\n`{current_room.name}`\n`{known_room.topic}` ->"
+                    f" `{current_room.topic}` `{room_id}`"
+                )
                 html_message = (
-                    f"<strong>Room topic update:</strong><br><code>{current_rooms[room_id].name}</code><br>"
-                    f"Old topic: <code>{known_rooms[room_id].topic}</code><br>"
-                    f"New topic:<code>{current_rooms[room_id].topic}</code><br><code>{room_id}</code>"
+                    f"<strong>Room topic update:</strong><br><code>{current_room.name}</code><br>"
+                    f"Old topic: <code>{known_room.topic}</code><br>"
+                    f"New topic:<code>{current_room.topic}</code><br><code>{room_id}</code>"
                 )
                 await self.post_message(text_message, html_message)
 
-    async def query_room_dir(self, max_retries) -> Dict[RoomID, PublicRoomInfo]:
-        all_rooms = {}
-
-        retries = 0
-        base_delay = 10
-        max_delay = 1800  # 30mins
-
-        pagination_token = DirectoryPaginationToken("")
-
-        # infinite loop since we need to loop over paginated results as well as upon failures (exceptions)
-        while True:
-            delay = min(base_delay * 2 ** retries, max_delay)
-
-            try:
-                directory = await self.client.get_room_directory(
-                    limit=1000,
-                    include_all_networks=False,
-                    since=pagination_token
+            if current_room.alias != known_room.alias:
+                text_message = (
+                    f"**Room alias update:**\n`{current_room.name}`\n`{known_room.alias}` -> `{current_room.alias}`"
+                    f" `{room_id}`"
                 )
-            except Exception as e:
-                if retries < max_retries:
-                    self.log.exception("failed to query room directory but will retry")
-                    await asyncio.sleep(delay)
-
-                    retries += 1
-                    continue
-                else:
-                    self.log.exception("failed to query room directory & exhausted max_retries")
-                    raise
-
-            retries = 0
-
-            if len(directory.chunk) > 0:
-                for room in directory.chunk:
-                    all_rooms[room.room_id] = room
-                    self._cache_room_details[room.room_id] = room
-
-            if directory.next_batch is None:
-                break
+                html_message = (
+                    f"<strong>Room alias update:</strong><br><code>{current_room.name}</code><br>"
+                    f"<code>{known_room.alias}</code> -> <code>{current_room.alias}</code><br><code>{room_id}</code>"
+                )
+                await self.post_message(text_message, html_message)
 
-            pagination_token = directory.next_batch
+    # All changes of a cycle in as few messages as possible, instead of one message per change
+    async def post_digest(self, removed: List[RoomInfo], added: List[RoomInfo],
+                          changed: List[Tuple[RoomInfo, RoomInfo]]) -> None:
+        renamed = [(known_room, current_room) for known_room, current_room in changed
+                   if known_room.name != current_room.name]
+        topic_changed = [(known_room, current_room) for known_room, current_room in changed
+                         if known_room.topic != current_room.topic]
+        alias_changed = [(known_room, current_room) for known_room, current_room in changed
+                         if known_room.alias != current_room.alias]
+        if not removed and not added and not renamed and not topic_changed and not alias_changed:
+            return
+
+        summary = (f"🔔 Room directory changes: {len(added)} added, {len(removed)} removed, {len(renamed)} renamed, "
+                   f"{len(topic_changed)} topics updated, {len(alias_changed)} aliases updated")
+        chunker = DigestChunker(summary, self.config["digest_max_size"])
+
+        for title, rooms in (("➕ Rooms added:", added), ("➖ Rooms removed:", removed)):
+            for room in rooms:
+                chunker.add(title, f"{room.name} `{room.room_id}`",
+                            f"{escape(room.name)} <code>{room.room_id}</code>")
+
+        for known_room, current_room in renamed:
+            chunker.add(
+                "Room name updates:",
+                f"`{known_room.name}` -> `{current_room.name}` `{current_room.room_id}`",
+                f"<code>{escape(known_room.name)}</code> -> <code>{escape(current_room.name)}</code> "
+                f"<code>{current_room.room_id}</code>"
+            )
+
+        for known_room, current_room in topic_changed:
+            old_topic, new_topic = shorten(known_room.topic), shorten(current_room.topic)
+            chunker.add(
+                "Room topic updates:",
+                f"`{current_room.name}` `{current_room.room_id}`: `{old_topic}` -> `{new_topic}`",
+                f"<code>{escape(current_room.name)}</code> <code>{current_room.room_id}</code><br>"
+                f"Old topic: <code>{escape(old_topic)}</code><br>New topic: <code>{escape(new_topic)}</code>"
+            )
+
+        for known_room, current_room in alias_changed:
+            chunker.add(
+                "Room alias updates:",
+                f"`{current_room.name}` `{current_room.room_id}`: `{known_room.alias}` -> `{current_room.alias}`",
+                f"<code>{escape(current_room.name)}</code> <code>{current_room.room_id}</code>: "
+                f"<code>{escape(known_room.alias)}</code> -> <code>{escape(current_room.alias)}</code>"
+            )
+
+        for text_message, html_message in chunker.get_messages():
+            await self.post_message(text_message, html_message)
 
-        return all_rooms
+    # The crawl is shared with other plugins, one less than half a monitoring interval old is reused unless it started
+    # before the last change applied from a state event. The shared directory has no topics, so new or changed rooms
+    # are detailed from the crawl waited for, or from the changes the crawls of others were notified with.
+    async def query_room_dir(self, max_retries, known_rooms: Dict[RoomID, int]) -> Crawl:
+        rooms = await self.room_directory.refresh(max_age=self._monitoring_interval / 2, max_retries=max_retries,
+                                                  not_before=self._last_state_applied_at)
+        crawl = self.compare_rooms(known_rooms, rooms)
+        if crawl is None:
+            # some changes were found by crawls made before this plugin started, they're all in a new crawl
+            rooms = await self.room_directory.refresh(max_retries=max_retries)
+            crawl = self.compare_rooms(known_rooms, rooms)
+            if crawl is None:
+                raise RuntimeError("room directory changed while comparing it with known rooms")
+        return crawl
+
+    # Returns None if the details of a new or changed room are unknown
+    def compare_rooms(self, known_rooms: Dict[RoomID, int],
+                      rooms: Optional[Dict[RoomID, DirectoryRoom]]) -> Optional[Crawl]:
+        crawl = Crawl()
+        crawl.pages = self.room_directory.last_crawl_pages
+        crawl.crawled_at = self.room_directory.crawled_at
+        for room_id, room in self.room_directory.rooms.items():
+            crawl.fingerprints[room_id] = room.fingerprint
+            if known_rooms.get(room_id) == room.fingerprint:
+                continue
+
+            details = rooms.get(room_id) if rooms is not None else None
+            if details is None or details.fingerprint != room.fingerprint:
+                details = self._changed_directory_rooms.get(room_id)
+                if details is None or details.fingerprint != room.fingerprint:
+                    return None
+            crawl.changed_rooms.append(RoomInfo.from_directory_room(details))
+
+        self._changed_directory_rooms.clear()
+        return crawl
+
+    def handle_directory_changes(self, changes: DirectoryChanges) -> None:
+        for room in (*changes.added, *(after for _, after in changes.changed)):
+            self._changed_directory_rooms[room.room_id] = room
+        for room in changes.removed:
+            self._changed_directory_rooms.pop(room.room_id, None)
 
     async def post_message(self, text, html=None):
-        await self.client.send_text(room_id=self.get_room_from_config(), text=text, html=html)
+        self.messages_total.inc()
+        # alerts can wait, messages of other plugins (e.g. mention pings) go first
+        room_id = self.get_room_from_config()
+        await self.send_scheduler.send(
+            room_id, lambda: self.client.send_text(room_id=room_id, text=text, html=html), PRIORITY_LOW
+        )
 
     async def post_notice(self, text, html=None):
-        await self.client.send_notice(room_id=self.get_room_from_config(), text=text, html=html)
+        room_id = self.get_room_from_config()
+        await self.send_scheduler.send(
+            room_id, lambda: self.client.send_notice(room_id=room_id, text=text, html=html), PRIORITY_LOW
+        )
@@ -0,0 +1 @@
+../../common/wporg_directory.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../common/wporg_metrics.py
\ No newline at end of file
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sys
+import unittest
+from typing import Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from mautrix.errors import MLimitExceeded
+
+from wporg_send import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, SendScheduler
+
+
+class SendSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.scheduler = SendScheduler(rate=1000, burst=1000, concurrency=1)
+        self.sent = []
+
+    def sender(self, room_id: str, name: str, started: Optional[asyncio.Event] = None,
+               release: Optional[asyncio.Event] = None):
+        async def send():
+            if started is not None:
+                started.set()
+            if release is not None:
+                await release.wait()
+            self.sent.append((room_id, name))
+            return name
+        return send
+
+    # Keeps the scheduler busy sending to a room until the returned event is set
+    async def block(self, room_id: str = "!busy") -> Tuple[asyncio.Task, asyncio.Event]:
+        started, release = asyncio.Event(), asyncio.Event()
+        task = asyncio.create_task(self.scheduler.send(room_id, self.sender(room_id, "busy", started, release)))
+        await started.wait()
+        return task, release
+
+    async def test_sends_to_a_room_in_order(self):
+        results = await asyncio.gather(*(
+            self.scheduler.send("!a", self.sender("!a", str(i))) for i in range(10)
+        ))
+
+        self.assertEqual(results, [str(i) for i in range(10)])
+        self.assertEqual(self.sent, [("!a", str(i)) for i in range(10)])
+        self.assertEqual(self.scheduler.sent, 10)
+        self.assertEqual(self.scheduler.get_queue_depth(), 0)
+
+    async def test_sends_higher_priority_first(self):
+        busy, release = await self.block()
+        tasks = [
+            asyncio.create_task(self.scheduler.send("!low", self.sender("!low", "low"), PRIORITY_LOW)),
+            asyncio.create_task(self.scheduler.send("!normal", self.sender("!normal", "normal"), PRIORITY_NORMAL)),
+            asyncio.create_task(self.scheduler.send("!high", self.sender("!high", "high"), PRIORITY_HIGH)),
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(busy, *tasks)
+
+        self.assertEqual([name for _, name in self.sent], ["busy", "high", "normal", "low"])
+
+    async def test_skips_cancelled_senders(self):
+        busy, release = await self.block()
+        # the next message of !a, once the cancelled one is skipped, is of another priority than the lane !a is in
+        cancelled = asyncio.create_task(self.scheduler.send("!a", self.sender("!a", "cancelled"), PRIORITY_HIGH))
+        await asyncio.sleep(0)
+        a = asyncio.create_task(self.scheduler.send("!a", self.sender("!a", "a"), PRIORITY_LOW))
+        b = asyncio.create_task(self.scheduler.send("!b", self.sender("!b", "b"), PRIORITY_LOW))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        release.set()
+        await asyncio.wait_for(asyncio.gather(busy, a, b), 1)
+
+        self.assertEqual([name for _, name in self.sent], ["busy", "a", "b"])
+
+        # the scheduler still sends afterwards
+        self.assertEqual(await asyncio.wait_for(self.scheduler.send("!a", self.sender("!a", "after")), 1), "after")
+        self.assertEqual(self.scheduler.get_queue_depth(), 0)
+
+    async def test_retries_rate_limited_messages(self):
+        attempts = 0
+
+        async def send():
+            nonlocal attempts
+            attempts += 1
+            if attempts < 3:
+                e = MLimitExceeded(429, "Too Many Requests")
+                e.retry_after_ms = 10
+                raise e
+            self.sent.append(("!a", "limited"))
+            return "limited"
+
+        results = await asyncio.wait_for(asyncio.gather(
+            self.scheduler.send("!a", send),
+            self.scheduler.send("!a", self.sender("!a", "next")),
+        ), 1)
+
+        self.assertEqual(results, ["limited", "next"])
+        # messages to the room stay in order
+        self.assertEqual([name for _, name in self.sent], ["limited", "next"])
+        self.assertEqual(attempts, 3)
+        self.assertEqual(self.scheduler.rate_limited, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()